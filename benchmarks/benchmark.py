@@ -0,0 +1,337 @@
+#Headless benchmarks for GtkPyInterpreterWidget.
+#
+#Runs on the current display, in a virtual X server (--xvfb) or with the
+#GDK broadway backend (--broadway) and writes the results as JSON; pass
+#--compare with the results of an earlier run to see the relative change.
+#
+#  python benchmarks/benchmark.py --xvfb -o results.json
+#  python benchmarks/benchmark.py --xvfb -o new.json --compare results.json
+import gc
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def start_display(options):
+  #must be called before Gtk is imported
+  if options.xvfb:
+    display = ':%d' % options.display
+    server = subprocess.Popen(['Xvfb', display, '-screen', '0', '1024x768x24',
+                               '-nolisten', 'tcp'])
+    os.environ['DISPLAY'] = display
+  elif options.broadway:
+    display = ':%d' % options.display
+    server = subprocess.Popen(['broadwayd', display])
+    os.environ['GDK_BACKEND'] = 'broadway'
+    os.environ['BROADWAY_DISPLAY'] = display
+  else:
+    return None
+  time.sleep(1)
+  return server
+
+
+#imports a widget class and creates it in a fresh process, prints the
+#seconds spent importing Gtk, importing the widget's module and creating it
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+sys.path[:0] = %r
+from gi.repository import Gtk
+gtk_imported = time.time()
+from %s import %s as Widget
+module_imported = time.time()
+widget = Widget()
+created = time.time()
+sys.stdout.write('%%f %%f %%f' %% (gtk_imported - start,
+                                 module_imported - gtk_imported,
+                                 created - module_imported))
+"""
+
+
+def rss():
+  #resident set size in bytes, Linux only
+  try:
+    f = open('/proc/self/statm')
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError):
+    return 0
+
+
+class Benchmark(object):
+
+  def __init__(self, repeat):
+    super(Benchmark, self).__init__()
+    from gi.repository import Gtk
+    from gtkpyinterpreter import GtkPyInterpreterWidget
+    self.Gtk = Gtk
+    self.repeat = repeat
+    self.window = Gtk.Window()
+    self.window.set_default_size(800, 600)
+    self.console = GtkPyInterpreterWidget({}, None)
+    self.window.add(self.console)
+    self.window.show_all()
+    self.wait_idle()
+
+  #helpers
+  def iterate(self):
+    while self.Gtk.events_pending():
+      self.Gtk.main_iteration_do(False)
+
+  def wait_idle(self, timeout=600):
+    #runs the main loop until the command has finished and all output has
+    #been inserted
+    start = time.time()
+    while time.time() - start < timeout:
+      self.iterate()
+      if not self.console.is_busy() and not self.console._writer.has_pending():
+        return
+      time.sleep(0.0005)
+    raise RuntimeError('timeout')
+
+  def key(self, keyval, state=0):
+    from gi.repository import Gdk
+    event = Gdk.Event.new(Gdk.EventType.KEY_PRESS)
+    event.key.keyval = keyval
+    event.key.state = state
+    event.key.window = self.console.output.get_window(
+                                              self.Gtk.TextWindowType.TEXT)
+    event.key.send_event = True
+    event.key.time = self.Gtk.get_current_event_time()
+    self.console.output.event(event)
+
+  def type_text(self, txt):
+    textbuffer = self.console.get_output_buffer()
+    textbuffer.insert(textbuffer.get_end_iter(), txt)
+
+  def run_command(self, cmd):
+    self.type_text(cmd)
+    start = time.time()
+    self.key(65293)
+    self.wait_idle()
+    return time.time() - start
+
+  def stats(self, values):
+    values = sorted(values)
+    return {'min': values[0], 'median': values[len(values) // 2],
+            'max': values[-1], 'n': len(values)}
+
+  #benchmarks
+  def bench_enter_to_prompt(self):
+    return self.stats([self.run_command('x = 1')
+                       for i in range(self.repeat * 10)])
+
+  def bench_output_throughput(self, n=100000):
+    results = {}
+    #commands have to fit on a single line
+    for name, cmd in [('small_writes', '_ = [stdout.write("%d\\n" % i) ' +
+                                       'for i in range(%d)]' % n),
+                      ('large_write', 'stdout.write(("x" * 79 + "\\n") * ' +
+                                      '%d)' % n)]:
+      self.console.interpreter.runsource('clear()')
+      self.wait_idle()
+      text = []
+      handler = self.console.connect('stdout-written',
+                                     lambda w, t: text.append(len(t)))
+      times = [self.run_command(cmd) for i in range(self.repeat)]
+      self.console.disconnect(handler)
+      best = min(times)
+      n_bytes = sum(text) / float(len(times))
+      results[name] = {'seconds': best, 'lines_per_s': n / best,
+                       'mb_per_s': n_bytes / best / 1e6}
+    return results
+
+  def bench_completion(self, n_names=100000):
+    console = self.console
+    for i in range(n_names):
+      console.interpreter.locals['name_%06d' % i] = i
+    console._completer.update()
+    results = {}
+    times = []
+    for i in range(self.repeat * 10):
+      console._replace_input('name_01')
+      console._prev_key = -1
+      start = time.time()
+      self.key(65289)
+      times.append(time.time() - start)
+    results['global'] = self.stats(times)
+    #attribute completion, until the results are delivered
+    console.interpreter.locals['os'] = os
+    times = []
+    for i in range(self.repeat * 10):
+      console._replace_input('os.pa')
+      console._prev_key = -1
+      delivered = []
+      start = time.time()
+      console._completer.complete_start('os.pa',
+                                        lambda t, m: delivered.append(m))
+      while delivered == [] and time.time() - start < 5:
+        self.iterate()
+      times.append(time.time() - start)
+    results['attribute'] = self.stats(times)
+    for i in range(n_names):
+      del console.interpreter.locals['name_%06d' % i]
+    console._completer.update()
+    console._replace_input('')
+    return results
+
+  def bench_history_load(self, n=1000000):
+    from gtkpyinterpreter.gtkpyinterpreter import CommandHistory
+    fd, filename = tempfile.mkstemp()
+    f = os.fdopen(fd, 'w')
+    for i in range(n):
+      f.write('x_%d = compute(%d)\n' % (i, i))
+    f.close()
+    results = {}
+    try:
+      start = time.time()
+      history = CommandHistory(filename, max_entries=n)
+      results['init'] = time.time() - start
+      len(history)
+      results['load'] = time.time() - start
+      start = time.time()
+      history.search('no such command')
+      results['search_miss'] = time.time() - start
+      history.close()
+    finally:
+      os.remove(filename)
+    return results
+
+  def bench_startup(self):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    path = [os.path.join(root, 'src'), os.path.join(root, 'demo')]
+    results = {}
+    for name, module, widget in [('widget', 'gtkpyinterpreter',
+                                  'GtkPyInterpreterWidget'),
+                                 ('matplotlib_shell', 'gtkmatplotlibshell',
+                                  'GtkMatplotlibShellWidget')]:
+      times = []
+      for i in range(self.repeat):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          STARTUP_SCRIPT % (path, module,
+                                                            widget)])
+        times.append([float(t) for t in output.split()])
+      times.sort(key=sum)
+      results[name] = {'import_gtk': times[0][0],
+                       'import_module': times[0][1],
+                       'create': times[0][2],
+                       'total': sum(times[0])}
+    return results
+
+  def bench_find(self, n=100000):
+    #searching the scrollback until the matches are highlighted
+    console = self.console
+    console.interpreter.runsource('clear()')
+    self.wait_idle()
+    self.run_command('_ = [stdout.write("line %d\\n" % i) for i in ' +
+                     'range(%d)]' % n)
+    console.show_find_bar()
+    times = []
+    for i in range(self.repeat):
+      console._find_entry.set_text('')
+      start = time.time()
+      console._find_entry.set_text('line 9999')
+      while (console._find_matches == [] and
+             time.time() - start < 60):
+        self.iterate()
+      times.append(time.time() - start)
+    console.hide_find_bar()
+    return self.stats(times)
+
+  def bench_memory_growth(self, n=200000):
+    self.console.interpreter.runsource('clear()')
+    self.wait_idle()
+    gc.collect()
+    before = rss()
+    self.run_command('_ = [stdout.write("x" * 70 + "\\n") ' +
+                     'for i in range(%d)]' % n)
+    gc.collect()
+    after = rss()
+    return {'rss_before': before, 'rss_after': after,
+            'bytes_per_line': (after - before) / float(n)}
+
+  def run(self, names):
+    results = {}
+    for name in names:
+      sys.stderr.write('running %s\n' % name)
+      results[name] = getattr(self, 'bench_' + name)()
+    return results
+
+
+def flatten(results, prefix=''):
+  items = {}
+  for key, value in results.items():
+    if isinstance(value, dict):
+      items.update(flatten(value, prefix + key + '.'))
+    elif isinstance(value, (int, float)):
+      items[prefix + key] = value
+  return items
+
+
+def compare(old, new):
+  old = flatten(old['results'])
+  new = flatten(new['results'])
+  for key in sorted(new.keys()):
+    if key in old and old[key] != 0:
+      change = (new[key] - old[key]) / float(old[key]) * 100
+      sys.stdout.write('%-45s %14.6g %14.6g %+8.1f%%\n' %
+                       (key, old[key], new[key], change))
+
+
+BENCHMARKS = ['startup', 'enter_to_prompt', 'output_throughput',
+              'completion', 'history_load', 'find', 'memory_growth']
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--xvfb', action='store_true', default=False,
+                    help='run in a virtual X server')
+  parser.add_option('--broadway', action='store_true', default=False,
+                    help='use the GDK broadway backend')
+  parser.add_option('--display', type='int', default=99)
+  parser.add_option('-o', '--output', default=None,
+                    help='write the results as JSON to this file')
+  parser.add_option('--compare', default=None,
+                    help='JSON results of an earlier run')
+  parser.add_option('-r', '--repeat', type='int', default=3)
+  parser.add_option('-b', '--benchmark', action='append', default=None,
+                    help='run only this benchmark, one of ' +
+                    ', '.join(BENCHMARKS))
+  options, args = parser.parse_args()
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', 'src'))
+  server = start_display(options)
+  try:
+    from gi.repository import Gtk
+    data = {'time': time.time(),
+            'python': platform.python_version(),
+            'gtk': '%d.%d.%d' % (Gtk.get_major_version(),
+                                 Gtk.get_minor_version(),
+                                 Gtk.get_micro_version()),
+            'platform': platform.platform(),
+            'results': Benchmark(options.repeat).run(options.benchmark or
+                                                     BENCHMARKS)}
+  finally:
+    if server != None:
+      server.terminate()
+  output = json.dumps(data, indent=2, sort_keys=True)
+  if options.output != None:
+    f = open(options.output, 'w')
+    f.write(output)
+    f.close()
+  else:
+    sys.stdout.write(output + '\n')
+  if options.compare != None:
+    f = open(options.compare)
+    compare(json.load(f), data)
+    f.close()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,13 +1,14 @@
-import hashlib
 import matplotlib
 matplotlib.use('Gtk3Agg')
-import matplotlib.pylab
-import time
-from gi.repository import GdkPixbuf
 
-from gtkpyinterpreter import GtkPyInterpreterWidget
+from gtkpyinterpreter import GtkPyInterpreterWidget, LazyStarImport
 
 
+def pylab():
+  #pylab is only imported when it is used for the first time
+  import matplotlib.pylab
+  return matplotlib.pylab
+
 
 class GtkMatplotlibShellWidget(GtkPyInterpreterWidget):
   
@@ -15,11 +16,12 @@ class GtkMatplotlibShellWidget(GtkPyInterpreterWidget):
   _dpi = 72
   banner = '\nWelcome to the matplotlib demo!'
   
-  def __init__(self, interpreter_locals={}, history_fn=None):
+  def __init__(self, interpreter_locals=None, history_fn=None):
     self._auto_plot = True
+    self._figure_dirty = False
     this_locals = {}
-    this_locals.update(matplotlib.pylab.__dict__)
-    this_locals['pylab'] = matplotlib.pylab
+    #the pylab names become available when one of them is used
+    this_locals['pylab'] = LazyStarImport('matplotlib.pylab')
     this_locals['autoplot'] = self._toggle_auto_plot
     this_locals['show'] = self._pylab_show
     this_locals['plot'] = self._pylab_plot
@@ -37,77 +39,99 @@ class GtkMatplotlibShellWidget(GtkPyInterpreterWidget):
     this_locals['contour'] = self._pylab_contour
     this_locals['contourf'] = self._pylab_contourf
     this_locals['colorbar'] = self._pylab_colorbar
-    this_locals.update(interpreter_locals)
+    this_locals.update(interpreter_locals or {})
     super(GtkMatplotlibShellWidget, self).__init__(this_locals, history_fn)
+    self.add_post_execute_hook(self._cb_post_execute)
+    
+  def _cb_post_execute(self):
+    #the figure is drawn once after the command that changed it
+    if self._figure_dirty:
+      self._pylab_show()
+    
+  def _mark_dirty(self):
+    if self._auto_plot:
+      self._figure_dirty = True
     
   def _toggle_auto_plot(self, enable=True):
     self._auto_plot = enable
     
   def _pylab_show(self):
-    fig = matplotlib.pylab.gcf()
-    temp_fn = '/tmp/' + hashlib.md5(str(time.time())).hexdigest() + '.png'
-    fig.savefig(temp_fn, figsize=self._figsize, dpi=self._dpi)
-    self.gtk_stdout.write_image(temp_fn)
+    #render the figure with Agg and pass its pixels to the output directly
+    self._figure_dirty = False
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = pylab().gcf()
+    canvas = fig.canvas
+    dpi = fig.get_dpi()
+    fig.set_dpi(self._dpi)
+    try:
+      agg_canvas = FigureCanvasAgg(fig)
+      agg_canvas.draw()
+      width, height = agg_canvas.get_renderer().get_canvas_width_height()
+      self.gtk_stdout.write_pixels(agg_canvas.buffer_rgba(), int(width),
+                                   int(height))
+    finally:
+      fig.set_dpi(dpi)
+      fig.set_canvas(canvas)
     
   def _pylab_plot(self, *args, **kwargs):
-    matplotlib.pylab.plot(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().plot(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_xlabel(self, *args, **kwargs):
-    matplotlib.pylab.xlabel(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().xlabel(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_ylabel(self, *args, **kwargs):
-    matplotlib.pylab.ylabel(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().ylabel(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_clabel(self, *args, **kwargs):
-    matplotlib.pylab.clabel(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().clabel(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_legend(self, *args, **kwargs):
-    matplotlib.pylab.legend(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().legend(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_title(self, *args, **kwargs):
-    matplotlib.pylab.title(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().title(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_errorbar(self, *args, **kwargs):
-    matplotlib.pylab.errorbar(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().errorbar(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_semilogy(self, *args, **kwargs):
-    matplotlib.pylab.semilogy(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().semilogy(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_pie(self, *args, **kwargs):
-    matplotlib.pylab.pie(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().pie(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_bar(self, *args, **kwargs):
-    matplotlib.pylab.bar(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().bar(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_hist(self, *args, **kwargs):
-    matplotlib.pylab.hist(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().hist(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_imshow(self, *args, **kwargs):
-    matplotlib.pylab.imshow(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().imshow(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_contour(self, *args, **kwargs):
-    matplotlib.pylab.contour(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().contour(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_contourf(self, *args, **kwargs):
-    matplotlib.pylab.contourf(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().contourf(*args, **kwargs)
+    self._mark_dirty()
     
   def _pylab_colorbar(self, *args, **kwargs):
-    matplotlib.pylab.colorbar(*args, **kwargs)
-    if self._auto_plot: self._pylab_show()
+    pylab().colorbar(*args, **kwargs)
+    self._mark_dirty()
 
 
 if __name__ == '__main__':
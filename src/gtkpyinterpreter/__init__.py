@@ -2,3 +2,7 @@
 __version__ = '0.1'
 
 from gtkpyinterpreter import GtkPyInterpreterWidget
+from gtkpyinterpreter import GtkInterpreter, GtkSubprocessInterpreter
+from gtkpyinterpreter import KernelPool
+from gtkpyinterpreter import CommandStatistics
+from lazy import Lazy, LazyImport, LazyStarImport
@@ -0,0 +1,154 @@
+import ast
+import threading
+import types
+import warnings
+
+
+#compiler flag allowing await, async for and async with outside of
+#functions, Python 3.8 and later
+TOP_LEVEL_AWAIT = getattr(ast, 'PyCF_ALLOW_TOP_LEVEL_AWAIT', 0)
+CO_COROUTINE = 0x0080
+
+
+def is_async(code):
+  #whether a command compiled with TOP_LEVEL_AWAIT awaits something; such
+  #code returns a coroutine instead of executing
+  return (isinstance(code, types.CodeType) and
+          code.co_flags & CO_COROUTINE != 0)
+
+
+class AsyncLoop(object):
+
+  #the asyncio event loop commands and their background tasks run on; it
+  #only runs while a command awaits something or when step() is called, so
+  #tasks make progress between commands as long as the owner keeps calling
+  #step() while has_work() is true; asyncio is imported on first use
+
+  #seconds between steps suggested by get_timeout() for loops whose
+  #scheduled callbacks are not known
+  poll_interval = 0.01
+
+  def __init__(self):
+    super(AsyncLoop, self).__init__()
+    import asyncio
+    self._asyncio = asyncio
+    #a loop created by a command, e.g. with asyncio.get_event_loop(), is
+    #adopted so that its tasks run too; one run by the application is left
+    #alone
+    policy = asyncio.get_event_loop_policy()
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', DeprecationWarning)
+      try:
+        loop = policy.get_event_loop()
+      except RuntimeError:
+        loop = None
+    if loop != None and loop.is_running():
+      loop = asyncio.new_event_loop()
+    elif loop == None or loop.is_closed():
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+    self.loop = loop
+
+  #private methods
+  def _cancel(self, task):
+    if not task.done():
+      task.cancel()
+
+  #public methods
+  def get_tasks(self):
+    if hasattr(self._asyncio, 'all_tasks'):
+      return self._asyncio.all_tasks(self.loop)
+    return set([task for task in self._asyncio.Task.all_tasks(self.loop)
+                if not task.done()])
+
+  def has_work(self):
+    #pending tasks or callbacks, e.g. of a future resolved by a thread
+    return (len(self.get_tasks()) > 0 or
+            len(getattr(self.loop, '_ready', ())) > 0 or
+            len(getattr(self.loop, '_scheduled', ())) > 0)
+
+  def get_timeout(self):
+    #seconds until the next scheduled callback is due, 0 if callbacks are
+    #ready, None if only events of the selector can give the loop work,
+    #see get_fileno()
+    if len(getattr(self.loop, '_ready', ())) > 0:
+      return 0
+    scheduled = getattr(self.loop, '_scheduled', None)
+    if scheduled == None:
+      return self.poll_interval if self.has_work() else None
+    if len(scheduled) == 0:
+      return None
+    #a heap, a cancelled handle at its top only causes an early step
+    return max(0, scheduled[0].when() - self.loop.time())
+
+  def get_fileno(self):
+    #a file descriptor that becomes readable when the loop's selector has
+    #events, e.g. data on a socket or a callback added from another thread,
+    #or None, e.g. for a select() or poll() based selector
+    try:
+      return self.loop._selector.fileno()
+    except (AttributeError, NotImplementedError, ValueError):
+      return None
+
+  def step(self):
+    #runs the callbacks that are ready and polls the loop's selector
+    #without blocking
+    self.loop.call_soon(self.loop.stop)
+    self.loop.run_forever()
+
+  def run_for(self, seconds):
+    #runs the loop for at most seconds, returns early once it has no work
+    deadline = self.loop.time() + seconds
+    self.step()
+    while self.has_work() and self.loop.time() < deadline:
+      self.loop.run_until_complete(self._asyncio.sleep(
+          min(0.01, max(0, deadline - self.loop.time()))))
+
+  def run(self, coroutine):
+    #runs the loop until the coroutine of a command is done, background
+    #tasks run meanwhile; returns the task, its result() raises the
+    #command's exception with a traceback of the command's frames only; an
+    #interrupt of the loop itself cancels the task and is raised
+    task = self._asyncio.ensure_future(coroutine, loop=self.loop)
+    try:
+      #unlike run_until_complete(task), waiting does not raise the
+      #exception of the task
+      self.loop.run_until_complete(self._asyncio.wait([task]))
+    except BaseException as e:
+      if task.done() and not task.cancelled() and task.exception() is e:
+        #raised by the command, e.g. KeyboardInterrupt
+        return task
+      self._cancel(task)
+      self.step()
+      raise e.with_traceback(None)
+    return task
+
+  def run_threadsafe(self, coroutine, wake=None):
+    #like run() from another thread while the loop's owner steps the loop,
+    #wake() asks it to do so; the calling thread waits in short intervals,
+    #so it can be interrupted
+    tasks = []
+    done = threading.Event()
+    def start():
+      tasks.append(self.loop.create_task(coroutine))
+      tasks[0].add_done_callback(lambda task: done.set())
+    self.loop.call_soon_threadsafe(start)
+    if wake != None:
+      wake()
+    try:
+      while not done.wait(0.05):
+        pass
+    except BaseException:
+      self.loop.call_soon_threadsafe(lambda: self._cancel(tasks[0]))
+      raise
+    return tasks[0]
+
+  def close(self):
+    for task in self.get_tasks():
+      task.cancel()
+    if self.loop.is_running():
+      return
+    try:
+      self.step()
+    finally:
+      self.loop.close()
@@ -0,0 +1,152 @@
+import os
+import sys
+import threading
+import time
+from memory import format_size, rss
+try:
+  import ctypes
+except ImportError:
+  ctypes = None
+
+
+class BudgetExceeded(KeyboardInterrupt):
+
+  #raised into a command that has exceeded one of its budgets; like
+  #KeyboardInterrupt it is not caught by 'except Exception'
+
+  budget = None
+
+
+class WallTimeExceeded(BudgetExceeded):
+  budget = 'wall time'
+
+
+class CpuTimeExceeded(BudgetExceeded):
+  budget = 'CPU time'
+
+
+class MemoryExceeded(BudgetExceeded):
+  budget = 'memory'
+
+
+def raise_in_thread(ident, exception):
+  #asynchronous exception, raised as soon as the thread executes Python
+  #code again, i.e. not while it is blocked in a system call; exception
+  #None clears a pending one
+  if ctypes == None or not hasattr(ctypes, 'pythonapi'):
+    return False
+  if sys.version_info >= (3, 7):
+    ident = ctypes.c_ulong(ident)
+  else:
+    ident = ctypes.c_long(ident)
+  if exception != None:
+    exception = ctypes.py_object(exception)
+  return ctypes.pythonapi.PyThreadState_SetAsyncExc(ident, exception) == 1
+
+
+def process_cpu_time():
+  t = os.times()
+  return t[0] + t[1]
+
+
+def thread_cpu_clock(ident):
+  #function returning the CPU time used by the thread, or by the process if
+  #that cannot be measured
+  if hasattr(time, 'pthread_getcpuclockid'):
+    try:
+      clock = time.pthread_getcpuclockid(ident)
+      return lambda: time.clock_gettime(clock)
+    except (OSError, OverflowError):
+      pass
+  return process_cpu_time
+
+
+class Watchdog(object):
+
+  #checks the budgets of a running command every interval seconds from a
+  #thread of its own and calls interrupt(exception class) once one of them
+  #is exceeded; budgets of 0 are unlimited, memory is the peak increase of
+  #the resident set size in bytes
+
+  interval = 0.05
+
+  def __init__(self, wall=0, cpu=0, memory=0):
+    super(Watchdog, self).__init__()
+    self.wall = wall
+    self.cpu = cpu
+    self.memory = memory
+    #the budget that has been exceeded by the latest command and the peak
+    #increase of the resident set size seen
+    self.exceeded = None
+    self.peak = 0
+    self._lock = threading.Lock()
+    self._stopped = threading.Event()
+    self._running = False
+    self._thread = None
+
+  #private methods
+  def _check(self):
+    if self.wall > 0 and time.time() - self._start > self.wall:
+      return WallTimeExceeded
+    if self.cpu > 0:
+      try:
+        if self._cpu_clock() - self._cpu_start > self.cpu:
+          return CpuTimeExceeded
+      except OSError:
+        #the thread has just ended
+        pass
+    if self.memory > 0:
+      self.peak = max(self.peak, rss() - self._rss_start)
+      if self.peak > self.memory:
+        return MemoryExceeded
+    return None
+
+  def _run(self):
+    while not self._stopped.wait(self.interval):
+      exceeded = self._check()
+      if exceeded != None:
+        with self._lock:
+          if self._running:
+            self.exceeded = exceeded
+            self._interrupt(exceeded)
+        return
+
+  #public methods
+  def is_limited(self):
+    return self.wall > 0 or self.cpu > 0 or self.memory > 0
+
+  def start(self, ident, interrupt):
+    #ident is the thread running the command
+    self.exceeded = None
+    self.peak = 0
+    self._interrupt = interrupt
+    self._cpu_clock = thread_cpu_clock(ident)
+    self._start = time.time()
+    self._cpu_start = self._cpu_clock()
+    self._rss_start = rss() if self.memory > 0 else 0
+    self._running = True
+    self._stopped.clear()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    #returns the exception class the command has been interrupted with, if
+    #any; interrupt is not called anymore once it returns
+    with self._lock:
+      self._running = False
+    self._stopped.set()
+    if self._thread != None:
+      self._thread.join()
+      self._thread = None
+    return self.exceeded
+
+  def describe(self):
+    #the budget that has been exceeded
+    if self.exceeded == MemoryExceeded:
+      limit = format_size(self.memory)[1:]
+    elif self.exceeded == CpuTimeExceeded:
+      limit = '%g s' % self.cpu
+    else:
+      limit = '%g s' % self.wall
+    return '%s budget of %s exceeded' % (self.exceeded.budget, limit)
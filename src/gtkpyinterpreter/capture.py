@@ -0,0 +1,184 @@
+import codecs
+import os
+import sys
+import tempfile
+import threading
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+try:
+  import ctypes
+  libc = ctypes.CDLL(None)
+except Exception:
+  libc = None
+
+
+#fallocate mode freeing a range of a file without changing its size, Linux
+#only
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+
+def _fallocate():
+  for name in ['fallocate64', 'fallocate']:
+    try:
+      function = getattr(libc, name)
+    except AttributeError:
+      continue
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong,
+                         ctypes.c_longlong]
+    return function
+  return None
+
+fallocate = _fallocate() if libc != None else None
+
+
+def flush_c_streams():
+  #output buffered by the C library, e.g. by printf in an extension module
+  if libc != None:
+    try:
+      libc.fflush(None)
+    except Exception:
+      pass
+
+
+def release_space(fd, length):
+  #gives the disk space of the first length bytes of a file back to the file
+  #system, the file keeps its size; returns whether that is supported
+  if fallocate == None:
+    return False
+  return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, 0,
+                   length) == 0
+
+
+class FdCapture(object):
+
+  #redirects file descriptors, usually 1 and 2, to unlinked temporary files
+  #between start() and stop(); writing to a regular file never blocks, so a
+  #library writing any amount while holding the GIL cannot fill up a pipe
+  #and deadlock; a reader thread tails the files, decodes the output and
+  #passes it to the write functions; on Linux the disk space of the output
+  #that has been read is released
+
+  read_size = 65536
+  #number of reads passed to a write function at once
+  batch_reads = 16
+  #seconds between polls of the files while a command runs and in between,
+  #when only processes started by earlier commands may still write
+  poll_interval = 0.01
+  idle_poll_interval = 0.25
+  #number of bytes read before their disk space is released
+  release_size = 1024 * 1024
+
+  def __init__(self, targets):
+    super(FdCapture, self).__init__()
+    #targets maps the file descriptors to write(text) functions
+    self.targets = dict(targets)
+    #fd -> [file fd, saved fd, decoder, read position, released bytes]
+    self._files = {}
+    self._lock = threading.Lock()
+    self._thread = None
+    self._stopped = threading.Event()
+    self._started = False
+
+  #private methods
+  def _flush(self):
+    flush_c_streams()
+    for stream in [sys.__stdout__, sys.__stderr__]:
+      try:
+        stream.flush()
+      except (AttributeError, IOError, ValueError):
+        pass
+
+  def _drain(self, fd, final=False):
+    #reads everything written so far; the decoder keeps an incomplete UTF-8
+    #sequence at the end of a read for the next one
+    with self._lock:
+      entry = self._files[fd]
+      while True:
+        chunks = []
+        more = True
+        for i in range(self.batch_reads):
+          data = os.pread(entry[0], self.read_size, entry[3])
+          if data == b'':
+            more = False
+            break
+          entry[3] += len(data)
+          chunks.append(entry[2].decode(data))
+        if final and not more:
+          chunks.append(entry[2].decode(b'', True))
+        text = ''.join(chunks)
+        if text != '':
+          self.targets[fd](text)
+        if entry[3] - entry[4] >= self.release_size:
+          if release_space(entry[0], entry[3]):
+            entry[4] = entry[3]
+        if not more:
+          return
+
+  def _run(self):
+    while not self._stopped.wait(self.poll_interval if self._started else
+                                 self.idle_poll_interval):
+      for fd in list(self._files.keys()):
+        self._drain(fd)
+
+  #public methods
+  def enable(self):
+    if fcntl == None or not hasattr(os, 'pread'):
+      raise OSError('file descriptors cannot be captured on this platform')
+    if self._thread != None:
+      return
+    for fd in sorted(self.targets.keys()):
+      file_fd, filename = tempfile.mkstemp(prefix='gtkpyinterpreter-')
+      os.unlink(filename)
+      #writes go to the end even after the space has been released, output
+      #of processes started by a command that outlive it is shown later
+      flags = fcntl.fcntl(file_fd, fcntl.F_GETFL)
+      fcntl.fcntl(file_fd, fcntl.F_SETFL, flags | os.O_APPEND)
+      self._files[fd] = [file_fd, None,
+                         codecs.getincrementaldecoder('utf-8')('replace'),
+                         0, 0]
+    self._stopped.clear()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def disable(self):
+    if self._thread == None:
+      return
+    self.stop()
+    self._stopped.set()
+    self._thread.join()
+    self._thread = None
+    for fd in list(self._files.keys()):
+      self._drain(fd, True)
+      os.close(self._files[fd][0])
+      del self._files[fd]
+
+  def is_enabled(self):
+    return self._thread != None
+
+  def start(self):
+    #called right before a command is executed
+    if self._thread == None or self._started:
+      return
+    self._flush()
+    for fd, entry in self._files.items():
+      entry[1] = os.dup(fd)
+      os.dup2(entry[0], fd)
+    self._started = True
+
+  def stop(self):
+    #restores the file descriptors, the output written so far has been
+    #passed on when it returns
+    if not self._started:
+      return
+    self._flush()
+    for fd, entry in self._files.items():
+      os.dup2(entry[1], fd)
+      os.close(entry[1])
+      entry[1] = None
+    self._started = False
+    for fd in self._files.keys():
+      self._drain(fd)
@@ -0,0 +1,196 @@
+import sys
+import time
+try:
+  import __builtin__ as builtins
+except ImportError:
+  import builtins
+
+
+def is_array(value):
+  #numpy arrays and objects imitating them, e.g. pandas or torch objects;
+  #their own repr is summarized already and iterating them is slow
+  return (hasattr(value, 'shape') and hasattr(value, 'dtype') and
+          not isinstance(value, type))
+
+
+class DisplayedResult(object):
+
+  #the representation of a value produced piece by piece, keeps a reference
+  #to the value until it has been shown completely
+
+  def __init__(self, pieces):
+    super(DisplayedResult, self).__init__()
+    self.complete = False
+    self._pieces = pieces
+    self._pending = ''
+
+  def take(self, max_bytes, max_time):
+    #the next part of the representation, at most max_bytes characters;
+    #stops early after max_time seconds, but only between two pieces, so
+    #nothing is left out; exceptions of repr are raised
+    deadline = time.time() + max_time
+    parts = [self._pending]
+    size = len(self._pending)
+    done = self._pieces == None
+    while not done and size < max_bytes and time.time() < deadline:
+      try:
+        part = next(self._pieces)
+      except StopIteration:
+        done = True
+        break
+      parts.append(part)
+      size += len(part)
+    text = ''.join(parts)
+    self._pending = text[max_bytes:]
+    if done:
+      self._pieces = None
+    self.complete = done and self._pending == ''
+    return text[:max_bytes]
+
+
+class ResultDisplay(object):
+
+  #replaces the default displayhook: the repr of a result is written up to
+  #max_bytes characters or as much as is produced in max_time seconds, the
+  #rest is written in chunks on request, see DisplayedResult
+
+  max_bytes = 4096
+  max_time = 0.05
+  #numpy arrays with more elements are summarized whatever the print
+  #options are
+  array_threshold = 1000
+  #size of the pieces long representations are cut into
+  piece_size = 1024
+  #containers nested deeper are represented at once
+  max_depth = 100
+  #budgets of each further chunk
+  expand_bytes = 65536
+  expand_time = 0.25
+
+  def __init__(self):
+    super(ResultDisplay, self).__init__()
+    self._formatters = {}
+
+  def _formatter(self, value):
+    for cls in getattr(type(value), '__mro__', (type(value),)):
+      if cls in self._formatters:
+        return self._formatters[cls]
+    return None
+
+  def _pieces(self, value, active=None):
+    #builtin containers are produced item by item, nested ones too, so that
+    #the budget can end the displayed part anywhere and the rest follows on
+    #request; active holds the ids of the containers being produced
+    formatter = self._formatter(value)
+    if formatter != None:
+      text = formatter(value)
+    elif is_array(value):
+      text = self._array_repr(value)
+    elif type(value) in [list, tuple, set, frozenset, dict] and len(value) > 0:
+      #subclasses may have their own repr
+      if active == None:
+        active = set()
+      if id(value) in active:
+        yield self._recursive_repr(value)
+        return
+      if len(active) >= self.max_depth:
+        text = repr(value)
+      else:
+        active.add(id(value))
+        try:
+          for piece in self._container_pieces(value, active):
+            yield piece
+        finally:
+          active.discard(id(value))
+        return
+    else:
+      text = repr(value)
+    for i in range(0, len(text), self.piece_size):
+      yield text[i:i + self.piece_size]
+
+  def _recursive_repr(self, value):
+    #like the builtin repr of a container that contains itself
+    if isinstance(value, list):
+      return '[...]'
+    elif isinstance(value, tuple):
+      return '(...)'
+    elif isinstance(value, dict):
+      return '{...}'
+    return type(value).__name__ + '(...)'
+
+  def _array_repr(self, value):
+    numpy = sys.modules.get('numpy')
+    if (numpy != None and isinstance(value, numpy.ndarray) and
+        hasattr(numpy, 'printoptions')):
+      with numpy.printoptions(threshold=self.array_threshold):
+        return repr(value)
+    return repr(value)
+
+  def _container_pieces(self, value, active):
+    if isinstance(value, dict):
+      opening, closing = '{', '}'
+    elif isinstance(value, list):
+      opening, closing = '[', ']'
+    elif isinstance(value, tuple):
+      opening, closing = '(', ',)' if len(value) == 1 else ')'
+    elif sys.version_info[0] < 3:
+      opening, closing = type(value).__name__ + '([', '])'
+    elif isinstance(value, frozenset):
+      opening, closing = 'frozenset({', '})'
+    else:
+      opening, closing = '{', '}'
+    yield opening
+    separator = ''
+    if isinstance(value, dict):
+      for k, v in value.items():
+        yield separator
+        for piece in self._pieces(k, active):
+          yield piece
+        yield ': '
+        for piece in self._pieces(v, active):
+          yield piece
+        separator = ', '
+    else:
+      for item in value:
+        yield separator
+        for piece in self._pieces(item, active):
+          yield piece
+        separator = ', '
+    yield closing
+
+  #public methods
+  def register(self, cls, formatter):
+    #formatter(value) returns the representation of instances of cls and
+    #its subclasses, e.g. a short summary of a large object
+    self._formatters[cls] = formatter
+
+  def unregister(self, cls):
+    self._formatters.pop(cls, None)
+
+  def format(self, value):
+    return DisplayedResult(self._pieces(value))
+
+  def display(self, value, stream):
+    #writes the first part of the representation to stream, an incomplete
+    #result is passed to stream.write_more(result)
+    result = self.format(value)
+    stream.write(result.take(self.max_bytes, self.max_time))
+    if not result.complete:
+      stream.write_more(result)
+    stream.write('\n')
+
+  def expand(self, result):
+    #the next chunk of an incomplete result as (text, complete)
+    try:
+      text = result.take(self.expand_bytes, self.expand_time)
+    except Exception as e:
+      #e.g. a dict changed while it was shown
+      return ' <%s: %s>' % (type(e).__name__, e), True
+    return text, result.complete
+
+  def displayhook(self, value, stream):
+    if value is None:
+      return
+    builtins._ = None
+    self.display(value, stream)
+    builtins._ = value
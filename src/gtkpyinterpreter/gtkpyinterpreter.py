@@ -1,38 +1,1415 @@
 from code import InteractiveInterpreter
-from rlcompleter import Completer
+from asyncloop import TOP_LEVEL_AWAIT, AsyncLoop, is_async
+from budget import Watchdog, raise_in_thread
+from capture import FdCapture
+from collections import OrderedDict, deque
+from display import ResultDisplay
+from kernel import AttributeLister, CodeCache, MessageReader, cpu_time
+from kernel import encode_message, run_block
+from lazy import LazyResolver
+from transcript import TranscriptWriter
+from magics import MagicCommands
+from memory import MemoryProfiler, MemoryTimeline, format_size
+from session import SessionStore
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import GObject
 from gi.repository import Pango
+import atexit
+import bisect
+import keyword
+import math
 import os
+import re
+import select
+import signal
+import subprocess
 import sys
-import __builtin__
+import threading
+import time
+import traceback
+import weakref
+import zlib
 import __main__
+try:
+  import __builtin__
+except ImportError:
+  import builtins as __builtin__
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
 
 
+#objects and the name of the method called at exit, e.g. to stop kernel
+#processes; they are not kept alive by it
+_exit_calls = weakref.WeakKeyDictionary()
+
+
+def _call_at_exit():
+  for obj, name in list(_exit_calls.items()):
+    getattr(obj, name)()
+
+atexit.register(_call_at_exit)
+
+
+def utf8_size(txt):
+  #number of bytes of txt encoded in UTF-8, ASCII text is not encoded
+  if isinstance(txt, bytes) or getattr(txt, 'isascii', lambda: False)():
+    return len(txt)
+  return len(txt.encode('utf-8', 'replace'))
+
+
+class CommandStatistics(object):
+  
+  #rolling statistics of the latest size commands, see
+  #GtkPyInterpreterWidget.set_statistics
+  
+  def __init__(self, size=1000):
+    super(CommandStatistics, self).__init__()
+    self._records = deque(maxlen=size)
+    self._lock = threading.Lock()
+    self.count = 0
+    self.errors = 0
+    
+  def _percentile(self, values, p):
+    if values == []:
+      return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+    
+  def add(self, source, wall, cpu, output_bytes, exception):
+    with self._lock:
+      self._records.append({'time': time.time(), 'source': source,
+                            'wall': wall, 'cpu': cpu,
+                            'output_bytes': output_bytes,
+                            'exception': exception})
+      self.count += 1
+      if exception != None:
+        self.errors += 1
+        
+  def get_records(self):
+    with self._lock:
+      return list(self._records)
+      
+  def summary(self):
+    #plain dictionary, e.g. for exporting to a monitoring system
+    records = self.get_records()
+    wall = sorted([r['wall'] for r in records])
+    cpu = [r['cpu'] for r in records]
+    return {'count': self.count, 'errors': self.errors,
+            'window': len(records),
+            'window_errors': len([r for r in records
+                                  if r['exception'] != None]),
+            'wall_mean': sum(wall) / len(wall) if wall != [] else 0.0,
+            'wall_median': self._percentile(wall, 0.5),
+            'wall_p95': self._percentile(wall, 0.95),
+            'wall_max': wall[-1] if wall != [] else 0.0,
+            'cpu_total': sum(cpu),
+            'output_bytes': sum([r['output_bytes'] for r in records])}
+    
+    
 class GtkInterpreter(InteractiveInterpreter):
   
-  def __init__(self, stdout, stderr, interpreter_locals):
+  #milliseconds between the steps of the asyncio event loop while it has
+  #tasks if its selector cannot be watched, see AsyncLoop
+  async_interval = 10
+  
+  def __init__(self, stdout, stderr, interpreter_locals, threaded=False,
+               finished_callback=None):
     InteractiveInterpreter.__init__(self, interpreter_locals)
     self.stdout = stdout
     self.stderr = stderr
+    self.threaded = threaded
+    self._finished_callback = finished_callback
+    self._initial_locals = dict(interpreter_locals)
+    self._worker = None
+    #thread saving the session, commands wait for it
+    self._saver = None
+    #commands awaiting something run as a task on the event loop, which is
+    #driven by the main loop
+    self.compile.compiler.flags |= TOP_LEVEL_AWAIT
+    self._async = None
+    self._async_task = None
+    self._async_source_id = None
+    self._async_watch_id = None
+    self._lister = AttributeLister()
+    self.code_cache = CodeCache()
+    self.lazy = LazyResolver(self.locals)
+    self.magics = MagicCommands()
+    self.magics.resolver = self.lazy
+    self.magics.session_exclude = self._session_exclude
+    self.display = ResultDisplay()
+    self._memory_profiler = None
+    self._fd_capture = None
+    self._watchdog = Watchdog()
+    #thread executing the current command, interrupt() raises into it
+    self._running_ident = None
+    self._interrupted = False
+    self._interrupt_lock = threading.Lock()
+    self._pre_execute_hooks = []
+    self._post_execute_hooks = []
+    self._exception = None
+    #source and timing of the latest command
+    self.last_source = None
+    self.last_stats = None
+    
+  def runsource(self, source, filename='<input>', symbol='single'):
+    #returns True if the source is incomplete
+    self.last_source = source
+    try:
+      code = self.code_cache.compile(self.compile, source, filename, symbol)
+    except (OverflowError, SyntaxError, ValueError):
+      self.showsyntaxerror(filename)
+      return False
+    if code == None:
+      return True
+    self.runcode(code)
+    return False
     
   def runcode(self, cmd):
+    self._started()
+    if is_async(cmd):
+      #interleaves with user interface events even without a worker thread
+      self._wait_for_saver()
+      self._run_async(cmd)
+      return None
+    if self.threaded:
+      #run the code in a worker thread, the output objects take care of
+      #passing the writes back to the main loop
+      self._worker = threading.Thread(target=self._run_worker, args=(cmd,))
+      self._worker.daemon = True
+      self._worker.start()
+      return None
+    self._wait_for_saver()
+    result = self._execute(cmd)
+    self._finished()
+    return result
+    
+  def runmagic(self, line, name, args):
+    #runs the magic command like a code object, see magics.MagicCommands
+    self.last_source = line
+    self.runcode(lambda: self.magics.run(name, args, self.locals))
+    
+  def runblock(self, source, filename='<input>', progress=None,
+               symbol='single'):
+    #executes the top-level statements of source one after the other like a
+    #single command, progress(i, n) is called from the main loop; symbol is
+    #'exec' for scripts, whose expression statements show no values
+    self.last_source = source
+    if progress != None and self.threaded:
+      report = lambda i, n: GLib.idle_add(progress, i, n)
+    else:
+      report = progress
+    self.runcode(lambda: run_block(self, source, filename, report,
+                                   symbol=symbol))
+    
+  def _run_callable(self, function):
+    try:
+      function()
+    except SystemExit:
+      raise
+    except:
+      self.showtraceback()
+    
+  def _execute(self, cmd):
+    self._exception = None
+    if self._memory_profiler != None:
+      self._memory_profiler.start()
+    start = time.time()
+    cpu_start = cpu_time()
     sys.stdout = self.stdout
     sys.stderr = self.stderr
-    result = InteractiveInterpreter.runcode(self, cmd)
-    sys.stdout = sys.__stdout__
-    sys.stderr = sys.__stderr__
+    sys.displayhook = self._displayhook
+    if self._fd_capture != None:
+      self._fd_capture.start()
+    ident = threading.current_thread().ident
+    with self._interrupt_lock:
+      self._running_ident = ident
+    watchdog = self._watchdog
+    if watchdog.is_limited():
+      watchdog.start(ident, lambda exception: raise_in_thread(ident,
+                                                              exception))
+    else:
+      watchdog = None
+    try:
+      if callable(cmd):
+        result = self._run_callable(cmd)
+      else:
+        result = self._run_callable(lambda: self.lazy.resolve(cmd))
+        if self._exception == None:
+          result = InteractiveInterpreter.runcode(self, cmd)
+    finally:
+      while True:
+        try:
+          self._stop_interrupts(ident, watchdog)
+          break
+        except KeyboardInterrupt:
+          #raised after the command had finished
+          pass
+      if self._fd_capture != None:
+        self._fd_capture.stop()
+      sys.stdout = sys.__stdout__
+      sys.stderr = sys.__stderr__
+      sys.displayhook = sys.__displayhook__
+      self.last_stats = {'wall': time.time() - start,
+                         'cpu': cpu_time() - cpu_start,
+                         'exception': self._exception,
+                         'memory': None}
+      if self._memory_profiler != None:
+        self.last_stats['memory'] = self._memory_profiler.stop()
     return result
     
+  def _displayhook(self, value):
+    self.display.displayhook(value, self.stdout)
+    
+  def _get_async_loop(self):
+    if self._async == None:
+      self._async = AsyncLoop()
+      fd = self._async.get_fileno()
+      if fd != None:
+        #events of the selector, e.g. of sockets, wake the event loop
+        self._async_watch_id = GLib.io_add_watch(fd, GLib.IO_IN,
+                                                 self._cb_async_io)
+    return self._async
+    
+  def _wake_async(self):
+    #steps the event loop from the main loop; called after each command, as
+    #it may have started background tasks
+    if self._async == None and 'asyncio' in sys.modules:
+      #tasks may have been scheduled on asyncio.get_event_loop()
+      self._get_async_loop()
+    if self._async != None:
+      self._schedule_async_step(0)
+    return False
+    
+  def _schedule_async_step(self, timeout):
+    #the next step in timeout seconds, only on events of the selector if
+    #None
+    if self._async_source_id != None:
+      GLib.source_remove(self._async_source_id)
+      self._async_source_id = None
+    if timeout != None:
+      self._async_source_id = GLib.timeout_add(int(math.ceil(timeout * 1000)),
+                                               self._cb_async_step)
+    
+  def _cb_async_io(self, fd, condition):
+    if self._async_source_id == None:
+      self._schedule_async_step(0)
+    return True
+    
+  def _cb_async_step(self):
+    self._async_source_id = None
+    #a command running in the worker thread has redirected the output
+    #already
+    redirect = self._worker == None
+    if redirect:
+      sys.stdout = self.stdout
+      sys.stderr = self.stderr
+      sys.displayhook = self._displayhook
+    try:
+      self._async.step()
+    except Exception:
+      self.stderr.write(traceback.format_exc())
+    finally:
+      if redirect:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        sys.displayhook = sys.__displayhook__
+    #until the next scheduled callback is due, tasks waiting for I/O or
+    #other threads are woken by the selector
+    timeout = self._async.get_timeout()
+    if self._async_watch_id == None and self._async.has_work():
+      #the selector cannot be watched, it is polled
+      interval = self.async_interval / 1000.0
+      if timeout == None or timeout > interval:
+        timeout = interval
+    self._schedule_async_step(timeout)
+    return False
+    
+  def _run_async(self, cmd):
+    #the command has finished when its task is done, see _cb_async_done
+    self._exception = None
+    try:
+      self.lazy.resolve(cmd)
+      coroutine = eval(cmd, self.locals)
+    except SystemExit:
+      raise
+    except:
+      self.showtraceback()
+      self.last_stats = {'wall': 0.0, 'cpu': 0.0,
+                         'exception': self._exception, 'memory': None}
+      self._finished()
+      return
+    loop = self._get_async_loop().loop
+    watchdog = self._watchdog
+    if watchdog.is_limited():
+      #the task is cancelled, the command's own thread is the main thread
+      watchdog.start(threading.current_thread().ident,
+                     lambda exception: loop.call_soon_threadsafe(
+                         self._cancel_async))
+    else:
+      watchdog = None
+    self._async_task = loop.create_task(coroutine)
+    self._async_task.add_done_callback(
+        lambda task, start=(time.time(), cpu_time()):
+        self._cb_async_done(task, start, watchdog))
+    self._wake_async()
+    
+  def _cancel_async(self):
+    if self._async_task != None:
+      self._async_task.cancel()
+      
+  def _cb_async_done(self, task, start, watchdog):
+    self._async_task = None
+    exceeded = None
+    if watchdog != None:
+      exceeded = watchdog.stop()
+    if task.cancelled():
+      self._exception = 'KeyboardInterrupt'
+      if exceeded != None:
+        self._exception = exceeded.__name__
+        self.stderr.write('Command interrupted: %s\n' % watchdog.describe())
+      else:
+        self.stderr.write('KeyboardInterrupt\n')
+    else:
+      try:
+        task.result()
+      except SystemExit:
+        raise
+      except:
+        self.showtraceback()
+    self.last_stats = {'wall': time.time() - start[0],
+                       'cpu': cpu_time() - start[1],
+                       'exception': self._exception, 'memory': None}
+    self._finished()
+    
+  def _stop_interrupts(self, ident, watchdog):
+    #no exception may be raised into the thread once the command has
+    #finished, a pending one is cleared
+    exceeded = None
+    if watchdog != None:
+      exceeded = watchdog.stop()
+    with self._interrupt_lock:
+      if exceeded != None or self._interrupted:
+        raise_in_thread(ident, None)
+      self._running_ident = None
+      self._interrupted = False
+    if exceeded != None:
+      self.stderr.write('Command interrupted: %s\n' % watchdog.describe())
+    
+  def _run_worker(self, cmd):
+    try:
+      self._wait_for_saver()
+      self._execute(cmd)
+    finally:
+      GLib.idle_add(self._cb_worker_done)
+    
+  def _cb_worker_done(self):
+    self._worker = None
+    self._finished()
+    return False
+    
+  def _started(self):
+    for hook in list(self._pre_execute_hooks):
+      try:
+        hook()
+      except Exception:
+        self.stderr.write(traceback.format_exc())
+    
+  def _finished(self):
+    #called from the main loop after each command
+    self._wake_async()
+    for hook in list(self._post_execute_hooks):
+      try:
+        hook()
+      except Exception:
+        self.stderr.write(traceback.format_exc())
+    if self._finished_callback != None:
+      self._finished_callback()
+      
+  def add_pre_execute_hook(self, hook):
+    #hook() is called right before a command is executed
+    if not hook in self._pre_execute_hooks:
+      self._pre_execute_hooks.append(hook)
+      
+  def remove_pre_execute_hook(self, hook):
+    if hook in self._pre_execute_hooks:
+      self._pre_execute_hooks.remove(hook)
+      
+  def add_post_execute_hook(self, hook):
+    #hook() is called from the main loop whenever a command has finished
+    if not hook in self._post_execute_hooks:
+      self._post_execute_hooks.append(hook)
+      
+  def remove_post_execute_hook(self, hook):
+    if hook in self._post_execute_hooks:
+      self._post_execute_hooks.remove(hook)
+      
+  def is_busy(self):
+    return self._worker != None or self._async_task != None
+    
+  def run_coroutine(self, coroutine):
+    #runs a coroutine of a command on the event loop, e.g. a statement of a
+    #block awaiting something, and returns its finished task; from the
+    #worker thread the main loop drives it, otherwise the main loop is
+    #blocked until it is done
+    loop = self._get_async_loop()
+    if self._worker != None and threading.current_thread() == self._worker:
+      return loop.run_threadsafe(coroutine,
+                                 lambda: GLib.idle_add(self._wake_async))
+    return loop.run(coroutine)
+    
+  def _run_lister(self, expr, names, callback, args):
+    try:
+      self._lister.list(self.locals, expr, names)
+      result = list(names)
+    except Exception:
+      result = []
+    GLib.idle_add(callback, result, *args)
+    
+  def list_attributes(self, expr, callback, *args):
+    #the attribute names are collected in a separate thread without calling
+    #user code, callback(names, *args) is called from the main loop; the
+    #returned list is filled while the names are collected
+    names = []
+    thread = threading.Thread(target=self._run_lister,
+                              args=(expr, names, callback, args))
+    thread.daemon = True
+    thread.start()
+    return names
+    
+  def expand_result(self, result, callback, *args):
+    #produces the next chunk of a result passed to stdout.write_more,
+    #callback(text, complete, *args) is called from the main loop
+    text, complete = self.display.expand(result)
+    callback(text, complete, *args)
+    
+  def _session_exclude(self):
+    #the predefined locals, e.g. the widget's stdout, are not saved
+    return [name for name, value in self._initial_locals.items()
+            if self.locals.get(name) is value]
+    
+  def _run_saver(self, previous, path, callback, args):
+    if previous != None:
+      previous.join()
+    try:
+      summary = SessionStore(path).save(self.locals, self._session_exclude())
+      error = None
+    except Exception as e:
+      summary = None
+      error = '%s: %s' % (type(e).__name__, e)
+    if callback != None:
+      GLib.idle_add(callback, summary, error, *args)
+      
+  def _wait_for_saver(self):
+    #the next command changes the namespace only once it has been saved;
+    #called from the worker thread if there is one
+    saver = self._saver
+    if saver != None:
+      saver.join()
+    
+  def save_session(self, path, callback=None, *args):
+    #saves the picklable variables to the directory path between commands
+    #in a separate thread, see session.SessionStore; callback(summary,
+    #error, *args) is called from the main loop
+    self._saver = threading.Thread(target=self._run_saver,
+                                   args=(self._saver, path, callback, args))
+    self._saver.daemon = True
+    self._saver.start()
+    
+  def register_formatter(self, cls, formatter):
+    #formatter(value) returns the representation of results that are
+    #instances of cls, see display.ResultDisplay
+    self.display.register(cls, formatter)
+    
+  def unregister_formatter(self, cls):
+    self.display.unregister(cls)
+    
+  def set_memory_profiling(self, enabled):
+    #measure the memory allocated by each command, see memory.MemoryProfiler
+    if enabled and self._memory_profiler == None:
+      self._memory_profiler = MemoryProfiler()
+      self._memory_profiler.enable()
+    elif not enabled and self._memory_profiler != None:
+      self._memory_profiler.disable()
+      self._memory_profiler = None
+      
+  def set_fd_capture(self, enabled):
+    #redirect the file descriptors 1 and 2 while a command runs, so the
+    #output of extension modules and child processes is shown as well
+    if enabled and self._fd_capture == None:
+      self._fd_capture = FdCapture({1: self.stdout.write,
+                                    2: self.stderr.write})
+      self._fd_capture.enable()
+    elif not enabled and self._fd_capture != None:
+      self._fd_capture.disable()
+      self._fd_capture = None
+      
+  def set_budgets(self, wall=0, cpu=0, memory=0):
+    #seconds of wall and CPU time and bytes of resident memory a command
+    #may use, 0 for no limit; a command exceeding them is interrupted with a
+    #budget.BudgetExceeded exception
+    self._watchdog = Watchdog(wall, cpu, memory)
+    
+  def interrupt(self):
+    #raises KeyboardInterrupt in a command running in the worker thread as
+    #soon as it executes Python code again, an asynchronous command is
+    #cancelled; returns whether the running command could be interrupted
+    if self._async_task != None:
+      self._async_task.cancel()
+      return True
+    with self._interrupt_lock:
+      if not self.threaded or self._running_ident == None:
+        return False
+      self._interrupted = raise_in_thread(self._running_ident,
+                                          KeyboardInterrupt)
+      return self._interrupted
+    
+  def restart(self):
+    #the in-process interpreter can only reset its namespace and cancel the
+    #running asynchronous command
+    self._cancel_async()
+    self.locals.clear()
+    self.locals.update(self._initial_locals)
+    self.lazy.reset()
+    
+  def shutdown(self):
+    self.set_fd_capture(False)
+    if self._async_source_id != None:
+      GLib.source_remove(self._async_source_id)
+      self._async_source_id = None
+    if self._async_watch_id != None:
+      GLib.source_remove(self._async_watch_id)
+      self._async_watch_id = None
+    if self._async != None:
+      self._async.close()
+      self._async = None
+    
+  def showtraceback(self, *args):
+    self._exception = sys.exc_info()[0].__name__
+    InteractiveInterpreter.showtraceback(self, *args)
+    
   def write(self, data):
-    if data.strip() != 'None':
-      self.stderr.write(data)
+    self.stderr.write(data)
+    
+    
+def start_kernel():
+  return subprocess.Popen([sys.executable, '-u',
+                           GtkSubprocessInterpreter.kernel_script],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          close_fds=True)
+  
+  
+class KernelPool(object):
+  
+  #keeps size kernel processes with the preload modules already imported;
+  #a GtkSubprocessInterpreter takes one when it starts or restarts and the
+  #pool is refilled from the main loop; install with
+  #GtkSubprocessInterpreter.pool = KernelPool(...)
+  
+  def __init__(self, size=2, preload=[]):
+    super(KernelPool, self).__init__()
+    self.size = size
+    self.preload = list(preload)
+    self._processes = []
+    self._refill_id = None
+    self.fill()
+    _exit_calls[self] = 'shutdown'
+    
+  #private methods
+  def _spawn(self):
+    process = start_kernel()
+    process.stdin.write(encode_message(('preload', sys.path, self.preload)))
+    process.stdin.flush()
+    return process
+    
+  def _kill(self, process):
+    #waiting processes have no state, they may still be importing modules
+    if process.poll() == None:
+      process.kill()
+    process.wait()
+    process.stdin.close()
+    process.stdout.close()
+    
+  def _cb_refill(self):
+    self._refill_id = None
+    self.fill()
+    return False
+    
+  #public methods
+  def fill(self):
+    #starts processes until there are size processes waiting
+    self._processes = [p for p in self._processes if p.poll() == None]
+    while len(self._processes) < self.size:
+      self._processes.append(self._spawn())
+      
+  def claim(self):
+    #returns a waiting kernel process or None if the pool is empty
+    process = None
+    while self._processes != [] and process == None:
+      process = self._processes.pop(0)
+      if process.poll() != None:
+        process = None
+    if self._refill_id == None and self.size > 0:
+      self._refill_id = GLib.idle_add(self._cb_refill)
+    return process
+    
+  def set_size(self, size):
+    self.size = size
+    while len(self._processes) > size:
+      self._kill(self._processes.pop())
+    self.fill()
+    
+  def set_preload(self, modules):
+    #the waiting processes are replaced
+    self.preload = list(modules)
+    self.shutdown()
+    self.fill()
+    
+  def shutdown(self):
+    _exit_calls.pop(self, None)
+    while self._processes != []:
+      self._kill(self._processes.pop())
+    
+    
+class GtkSubprocessInterpreter(GtkInterpreter):
+  
+  #runs the code in a child python process, see kernel.py; commands are
+  #compiled locally to detect incomplete input and syntax errors and sent
+  #to the kernel as source, its output is streamed back
+  
+  kernel_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'kernel.py')
+  #KernelPool new kernels are taken from, shared by all interpreters
+  pool = None
+  #seconds a kernel gets to finish its requests, e.g. a session save, and
+  #send its output before it is killed
+  shutdown_timeout = 1.0
+  
+  def __init__(self, stdout, stderr, interpreter_locals, threaded=True,
+               finished_callback=None):
+    #the local namespace only mirrors the names defined in the kernel
+    GtkInterpreter.__init__(self, stdout, stderr, {}, True,
+                            finished_callback)
+    self._kernel_locals = {}
+    for name, value in interpreter_locals.items():
+      try:
+        self._kernel_locals[name] = pickle.dumps(value, 2)
+      except Exception:
+        pass
+    self._source = None
+    self._progress = None
+    self._memory_profiling = False
+    self._fd_capture_enabled = False
+    self._budgets = (0, 0, 0)
+    #pickled formatters, sent again to a new kernel
+    self._formatters = OrderedDict()
+    #incomplete results refer to the kernel they were displayed by
+    self._generation = 0
+    self._start_time = 0
+    self._busy = False
+    self._requests = {}
+    self._request_id = 0
+    self._process = None
+    self._watch_id = None
+    self._reader = None
+    self._start()
+    _exit_calls[self] = 'shutdown'
+    
+  #private methods
+  def _start(self):
+    self._process = None
+    if self.pool != None:
+      self._process = self.pool.claim()
+    if self._process == None:
+      self._process = start_kernel()
+    self._reader = MessageReader()
+    self._watch_id = GLib.io_add_watch(self._process.stdout.fileno(),
+                                       GLib.IO_IN | GLib.IO_HUP |
+                                       GLib.IO_ERR, self._cb_kernel_io)
+    self.locals.clear()
+    self._requests = {}
+    self._generation += 1
+    self._send(('init', sys.path, self._kernel_locals))
+    if self._memory_profiling:
+      self._send(('memory-profiling', True))
+    if self._fd_capture_enabled:
+      self._send(('fd-capture', True))
+    if self._budgets != (0, 0, 0):
+      self._send(('budgets',) + self._budgets)
+    for data in self._formatters.values():
+      self._send(('formatter', data))
+    
+  def _drain(self, timeout=0):
+    #passes on the output and session saves the kernel sends while exiting,
+    #waits at most timeout seconds for the first data
+    fd = self._process.stdout.fileno()
+    while select.select([fd], [], [], timeout)[0] != []:
+      timeout = 0
+      data = os.read(fd, 65536)
+      if data == b'':
+        break
+      for msg in self._reader.feed(data):
+        if msg[0] in ['stdout', 'stderr', 'clear', 'saved']:
+          self._handle_message(msg)
+    
+  def _stop(self):
+    if self._process != None:
+      try:
+        self._send(('shutdown',))
+      except (IOError, OSError):
+        pass
+      #the kernel finishes the pending requests unless a command is running,
+      #its output is read meanwhile so that it cannot block on the pipe
+      deadline = time.time() + self.shutdown_timeout
+      while self._process.poll() == None and time.time() < deadline:
+        self._drain(0.01)
+    if self._watch_id != None:
+      GLib.source_remove(self._watch_id)
+      self._watch_id = None
+    if self._process != None:
+      self._drain()
+      if self._process.poll() == None:
+        self._process.kill()
+      self._process.wait()
+      self._process.stdin.close()
+      self._process.stdout.close()
+      self._process = None
+      
+  def _send(self, msg):
+    self._process.stdin.write(encode_message(msg))
+    self._process.stdin.flush()
+    
+  def _cb_kernel_io(self, fd, condition):
+    data = b''
+    if condition & GLib.IO_IN:
+      data = os.read(fd, 65536)
+    if data == b'':
+      #the kernel process has died
+      self._watch_id = None
+      self._stop()
+      self.stderr.write('\nThe interpreter process has died, restarting.\n')
+      self._start()
+      self._command_done('KernelDied')
+      return False
+    for msg in self._reader.feed(data):
+      self._handle_message(msg)
+    return True
+    
+  def _handle_message(self, msg):
+    if msg[0] == 'stdout':
+      self.stdout.write(msg[1])
+    elif msg[0] == 'stderr':
+      self.stderr.write(msg[1])
+    elif msg[0] == 'namespace':
+      for name in msg[1]:
+        self.locals[name] = None
+      for name in msg[2]:
+        self.locals.pop(name, None)
+    elif msg[0] in ['attributes', 'expanded', 'saved']:
+      if msg[1] in self._requests:
+        callback, args = self._requests.pop(msg[1])
+        callback(*(tuple(msg[2:]) + args))
+    elif msg[0] == 'more':
+      self.stdout.write_more((self._generation, msg[1]))
+    elif msg[0] == 'clear':
+      self.stdout.clear()
+    elif msg[0] == 'progress':
+      if self._progress != None:
+        self._progress(msg[1], msg[2])
+    elif msg[0] == 'done':
+      self.last_stats = msg[1]
+      self._command_done()
+      
+  def _command_done(self, exception=None):
+    if self._busy:
+      self._busy = False
+      if exception != None:
+        self.last_stats = {'wall': time.time() - self._start_time, 'cpu': 0.0,
+                           'exception': exception, 'memory': None}
+      self._finished()
+    
+  #public methods
+  def runsource(self, source, filename='<input>', symbol='single'):
+    self._source = (source, filename, symbol)
+    return GtkInterpreter.runsource(self, source, filename, symbol)
+    
+  def runcode(self, cmd):
+    #code objects cannot be sent to the kernel, it compiles the source again
+    self._run_command(('run',) + self._source)
+    
+  def runmagic(self, line, name, args):
+    self.last_source = line
+    self._run_command(('magic', name, args))
+    
+  def runblock(self, source, filename='<input>', progress=None,
+               symbol='single'):
+    self.last_source = source
+    self._progress = progress
+    self._run_command(('block', source, filename, symbol))
+    
+  def _wake_async(self):
+    #commands awaiting something and background tasks run in the kernel
+    return False
+    
+  def _run_command(self, msg):
+    self._started()
+    self._busy = True
+    self._start_time = time.time()
+    self._send(msg)
+    
+  def is_busy(self):
+    return self._busy
+    
+  def list_attributes(self, expr, callback, *args):
+    #answered by the kernel even while it runs a command
+    self._request_id += 1
+    self._requests[self._request_id] = (callback, args)
+    self._send(('attributes', self._request_id, expr))
+    return []
+    
+  def expand_result(self, result, callback, *args):
+    #the rest of the result is kept by the kernel, it answers once it is
+    #idle
+    generation, result_id = result
+    if generation != self._generation:
+      callback('', True, *args)
+      return
+    self._request_id += 1
+    self._requests[self._request_id] = (callback, args)
+    self._send(('expand', self._request_id, result_id))
+    
+  def save_session(self, path, callback=None, *args):
+    #the kernel saves its namespace once it is idle
+    self._request_id += 1
+    if callback != None:
+      self._requests[self._request_id] = (callback, args)
+    self._send(('save-session', self._request_id, path))
+    
+  def register_formatter(self, cls, formatter):
+    #cls and formatter are pickled by reference, the kernel has to be able
+    #to import them
+    self._formatters[cls] = pickle.dumps((cls, formatter), 2)
+    self._send(('formatter', self._formatters[cls]))
+    
+  def unregister_formatter(self, cls):
+    if cls in self._formatters:
+      del self._formatters[cls]
+      self._send(('formatter', pickle.dumps((cls, None), 2)))
+    
+  def set_memory_profiling(self, enabled):
+    #the kernel measures the memory, the setting survives restarts
+    self._memory_profiling = enabled
+    self._send(('memory-profiling', enabled))
+    
+  def set_fd_capture(self, enabled):
+    #the kernel's file descriptors are redirected, the setting survives
+    #restarts
+    self._fd_capture_enabled = enabled
+    self._send(('fd-capture', enabled))
+    
+  def set_budgets(self, wall=0, cpu=0, memory=0):
+    #enforced by the kernel, the budgets survive restarts
+    self._budgets = (wall, cpu, memory)
+    self._send(('budgets',) + self._budgets)
+    
+  def interrupt(self):
+    if not self._busy:
+      return False
+    os.kill(self._process.pid, signal.SIGINT)
+    return True
+    
+  def restart(self):
+    self._stop()
+    self._start()
+    self._command_done('KernelRestart')
+    
+  def shutdown(self):
+    _exit_calls.pop(self, None)
+    self._stop()
+    
+    
+class GtkInterpreterImageStore(object):
+  
+  #the output only shows thumbnails of at most thumbnail_size pixels, the
+  #full resolution pixels are kept zlib compressed in a LRU limited to
+  #max_bytes and decoded when needed
+  thumbnail_size = 400
+  
+  def __init__(self, max_bytes=32 * 1024 * 1024):
+    super(GtkInterpreterImageStore, self).__init__()
+    self.max_bytes = max_bytes
+    self._images = OrderedDict()
+    self._thumbnails = {}
+    self._bytes = 0
+    self._next_id = 0
+    self._lock = threading.Lock()
+    
+  #private methods
+  def _evict(self):
+    while self._bytes > self.max_bytes and len(self._images) > 0:
+      image_id, image = self._images.popitem(False)
+      self._bytes -= len(image[4])
+      
+  def _thumbnail(self, pixbuf):
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    scale = float(self.thumbnail_size) / max(width, height)
+    if scale >= 1:
+      return pixbuf
+    return pixbuf.scale_simple(max(1, int(width * scale)),
+                               max(1, int(height * scale)),
+                               GdkPixbuf.InterpType.BILINEAR)
+    
+  #public methods
+  def add(self, pixbuf):
+    #returns the id of the image and the thumbnail to be shown
+    thumbnail = self._thumbnail(pixbuf)
+    if thumbnail is not pixbuf:
+      image = (pixbuf.get_width(), pixbuf.get_height(),
+               pixbuf.get_rowstride(), pixbuf.get_has_alpha(),
+               zlib.compress(pixbuf.get_pixels(), 1))
+    else:
+      image = None
+    with self._lock:
+      image_id = self._next_id
+      self._next_id += 1
+      self._thumbnails[image_id] = (thumbnail.get_rowstride() *
+                                    thumbnail.get_height())
+      if image != None:
+        self._images[image_id] = image
+        self._bytes += len(image[4])
+        self._evict()
+    return image_id, thumbnail
+    
+  def get(self, image_id):
+    #the full resolution pixbuf or None if it is not (or no longer) stored
+    with self._lock:
+      image = self._images.pop(image_id, None)
+      if image == None:
+        return None
+      self._images[image_id] = image
+    width, height, rowstride, has_alpha, data = image
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+                              GLib.Bytes.new(zlib.decompress(data)),
+                              GdkPixbuf.Colorspace.RGB, has_alpha, 8,
+                              width, height, rowstride)
+                              
+  def release(self, image_id):
+    #called when the image has been removed from the output
+    with self._lock:
+      self._thumbnails.pop(image_id, None)
+      image = self._images.pop(image_id, None)
+      if image != None:
+        self._bytes -= len(image[4])
+        
+  def get_memory(self):
+    #bytes used by the thumbnails and the compressed images
+    with self._lock:
+      return self._bytes + sum(self._thumbnails.values())
+      
+  def set_max_bytes(self, max_bytes):
+    with self._lock:
+      self.max_bytes = max_bytes
+      self._evict()
+    
+    
+class GtkInterpreterOutputIndex(object):
+  
+  #the text inserted by the output writer as chunks of [mark, text, stream,
+  #joined], joined meaning that the chunk directly follows the previous one;
+  #the output can be searched in a thread without reading the TextBuffer and
+  #the marks keep the positions of the chunks up to date
+  
+  #maximum number of matches returned by a search
+  max_matches = 10000
+  
+  def __init__(self):
+    super(GtkInterpreterOutputIndex, self).__init__()
+    self._chunks = deque()
+    
+  #public methods
+  def append(self, textbuffer, offset, text, stream):
+    #text has just been inserted at offset
+    joined = False
+    if len(self._chunks) > 0:
+      mark, previous = self._chunks[-1][:2]
+      joined = (textbuffer.get_iter_at_mark(mark).get_offset() +
+                len(previous) == offset)
+    mark = textbuffer.create_mark(None, textbuffer.get_iter_at_offset(offset),
+                                  True)
+    self._chunks.append([mark, text, stream, joined])
+    
+  def insert(self, textbuffer, offset, text, stream):
+    #text has been inserted at offset in front of later output, e.g. an
+    #expanded result
+    low = 0
+    high = len(self._chunks)
+    while low < high:
+      middle = (low + high) // 2
+      mark = self._chunks[middle][0]
+      if textbuffer.get_iter_at_mark(mark).get_offset() <= offset:
+        low = middle + 1
+      else:
+        high = middle
+    joined = False
+    if low > 0:
+      chunk = self._chunks[low - 1]
+      joined = (textbuffer.get_iter_at_mark(chunk[0]).get_offset() +
+                len(chunk[1]) == offset)
+      if joined and chunk[2] == stream:
+        chunk[1] += text
+        return
+    mark = textbuffer.create_mark(None, textbuffer.get_iter_at_offset(offset),
+                                  True)
+    self._chunks.insert(low, [mark, text, stream, joined])
+    
+  def trim(self, textbuffer, end):
+    #called before the text up to offset end is deleted; search results
+    #refer to the marks, a deleted mark means the match has been removed
+    while len(self._chunks) > 0:
+      chunk = self._chunks[0]
+      start = textbuffer.get_iter_at_mark(chunk[0]).get_offset()
+      if start >= end:
+        break
+      if start + len(chunk[1]) > end:
+        #the rest of the chunk gets a new mark
+        textbuffer.delete_mark(chunk[0])
+        chunk[0] = textbuffer.create_mark(None,
+                                          textbuffer.get_iter_at_offset(end),
+                                          True)
+        chunk[1] = chunk[1][end - start:]
+        break
+      textbuffer.delete_mark(chunk[0])
+      self._chunks.popleft()
+      
+  def clear(self, textbuffer):
+    for chunk in self._chunks:
+      textbuffer.delete_mark(chunk[0])
+    self._chunks.clear()
+    
+  def snapshot(self):
+    #the chunks are only changed from the main loop
+    return [tuple(chunk) for chunk in self._chunks]
+    
+  def search(self, chunks, expression, stream=None):
+    #matches of the compiled expression in a snapshot as (mark, offset,
+    #length) with the offset relative to the mark, only in the chunks of
+    #stream if it is not None; can be called from any thread
+    texts = []
+    starts = []
+    selected = []
+    n = 0
+    previous = None
+    for i, (mark, text, chunk_stream, joined) in enumerate(chunks):
+      if stream != None and chunk_stream != stream:
+        continue
+      if texts != [] and not (joined and previous == i - 1):
+        #matches must not span text that is not in the index
+        texts.append('\0')
+        n += 1
+      texts.append(text)
+      starts.append(n)
+      selected.append(mark)
+      n += len(text)
+      previous = i
+    matches = []
+    for match in expression.finditer(''.join(texts)):
+      start, end = match.span()
+      if start == end:
+        continue
+      i = bisect.bisect_right(starts, start) - 1
+      matches.append((selected[i], start - starts[i], end - start))
+      if len(matches) >= self.max_matches:
+        break
+    return matches
+    
+    
+class GtkInterpreterOutputWriter(object):
+  
+  #time in seconds a single idle flush may spend inserting pending output
+  flush_budget = 0.008
+  #number of queued writes taken from the queue at once
+  batch_size = 512
+  #maximum number of lines removed from the scrollback per flush
+  trim_chunk = 2000
+  #number of incomplete results that can be expanded, older ones are
+  #released
+  max_results = 20
+  more_text = ' ... [show more]'
+  
+  def __init__(self, textview):
+    super(GtkInterpreterOutputWriter, self).__init__()
+    self.textview = textview
+    self.max_lines = 0
+    self.max_chars = 0
+    self.images = GtkInterpreterImageStore()
+    #the output text for the find bar
+    self.index = GtkInterpreterOutputIndex()
+    #incomplete results shown with a link, id -> (result, mark)
+    self._results = OrderedDict()
+    self._next_result_id = 0
+    #TranscriptWriter receiving the writes except for prompts and footers
+    self.transcript = None
+    #size of the text written in UTF-8
+    self.bytes_written = 0
+    self._pending = []
+    self._trim_pending = False
+    self._lock = threading.Lock()
+    self._idle_id = None
+    
+  #private methods
+  def _queue(self, item):
+    with self._lock:
+      self._pending.append(item)
+      self._schedule_flush()
+      
+  def _schedule_flush(self):
+    if self._idle_id == None:
+      self._idle_id = GLib.idle_add(self._cb_flush)
+        
+  def _cb_flush(self):
+    self.flush(self.flush_budget)
+    with self._lock:
+      if self._pending != [] or self._trim_pending:
+        return True
+      self._idle_id = None
+      return False
+      
+  def _trim(self, textbuffer, max_trim_lines):
+    #delete the oldest lines exceeding the scrollback limits, never touches
+    #the line containing the input_start mark; returns whether there are
+    #still lines to remove
+    n_lines = textbuffer.get_line_count()
+    n_chars = textbuffer.get_char_count()
+    trim_lines = 0
+    if self.max_lines > 0 and n_lines > self.max_lines:
+      #trim a little more than necessary to not trim on every flush
+      trim_lines = n_lines - self.max_lines + self.max_lines // 20
+    if self.max_chars > 0 and n_chars > self.max_chars:
+      trim_iter = textbuffer.get_iter_at_offset(n_chars - self.max_chars +
+                                                self.max_chars // 20)
+      trim_lines = max(trim_lines, trim_iter.get_line() + 1)
+    if trim_lines == 0:
+      return False
+    input_line = textbuffer.get_iter_at_mark(
+                              textbuffer.get_mark('input_start')).get_line()
+    more = trim_lines > max_trim_lines
+    trim_lines = min(trim_lines, max_trim_lines, input_line)
+    if trim_lines <= 0:
+      return False
+    end_iter = textbuffer.get_iter_at_line(trim_lines)
+    self.index.trim(textbuffer, end_iter.get_offset())
+    textbuffer.delete(textbuffer.get_start_iter(), end_iter)
+    return more and trim_lines < input_line
+      
+  def _insert_text(self, textbuffer, chunks, tag_names):
+    if chunks != []:
+      text = ''.join(chunks)
+      offset = textbuffer.get_end_iter().get_offset()
+      textbuffer.insert_with_tags_by_name(textbuffer.get_end_iter(), text,
+                                          *tag_names)
+      if not 'prompt' in tag_names and not 'footer' in tag_names:
+        self.index.append(textbuffer, offset, text,
+                          'stderr' if 'error' in tag_names else 'stdout')
+                                          
+  def _insert_pixbuf(self, textbuffer, image):
+    image_id, pixbuf = image
+    offset = textbuffer.get_end_iter().get_offset()
+    textbuffer.insert(textbuffer.get_end_iter(), '\n')
+    textbuffer.insert_pixbuf(textbuffer.get_end_iter(), pixbuf)
+    textbuffer.insert(textbuffer.get_end_iter(), '\n')
+    textbuffer.apply_tag_by_name('protected',
+                                 textbuffer.get_iter_at_offset(offset),
+                                 textbuffer.get_end_iter())
+    #the image is found by its tag, both are released with the pixbuf
+    tag = textbuffer.create_tag('image-%d' % image_id)
+    textbuffer.apply_tag(tag, textbuffer.get_iter_at_offset(offset + 1),
+                         textbuffer.get_iter_at_offset(offset + 2))
+    pixbuf.weak_ref(self._cb_image_released, image_id)
+    
+  def _insert_more(self, textbuffer, result):
+    #the link expanding the result in place, see expand_result
+    tag_table = textbuffer.get_tag_table()
+    if tag_table.lookup('more') == None:
+      textbuffer.create_tag(tag_name='more', foreground='#3465a4',
+                            underline=Pango.Underline.SINGLE)
+    result_id = self._next_result_id
+    self._next_result_id += 1
+    offset = textbuffer.get_end_iter().get_offset()
+    textbuffer.insert_with_tags(textbuffer.get_end_iter(), self.more_text,
+                                tag_table.lookup('protected'),
+                                tag_table.lookup('more'),
+                                textbuffer.create_tag('more-%d' % result_id))
+    #text inserted at the mark ends up in front of the link
+    mark = textbuffer.create_mark(None, textbuffer.get_iter_at_offset(offset),
+                                  False)
+    self._results[result_id] = (result, mark)
+    while len(self._results) > self.max_results:
+      self._release_result(textbuffer, list(self._results.keys())[0], '...')
+      
+  def _link_range(self, textbuffer, result_id):
+    #start and end iter of the link or None if it has been removed
+    mark = self._results[result_id][1]
+    tag = textbuffer.get_tag_table().lookup('more-%d' % result_id)
+    start_iter = textbuffer.get_iter_at_mark(mark)
+    if not start_iter.has_tag(tag):
+      return None
+    end_iter = start_iter.copy()
+    end_iter.forward_to_tag_toggle(tag)
+    return start_iter, end_iter
+    
+  def _release_result(self, textbuffer, result_id, replacement):
+    #drops the reference to the result, the link is replaced
+    link = self._link_range(textbuffer, result_id)
+    if link != None:
+      if replacement != '':
+        textbuffer.insert_with_tags_by_name(link[0], replacement, 'protected')
+      textbuffer.delete(*self._link_range(textbuffer, result_id))
+    result, mark = self._results.pop(result_id)
+    textbuffer.delete_mark(mark)
+    tag_table = textbuffer.get_tag_table()
+    tag_table.remove(tag_table.lookup('more-%d' % result_id))
+    
+  def _cb_image_released(self, image_id):
+    self.images.release(image_id)
+    tag_table = self.textview.get_buffer().get_tag_table()
+    tag = tag_table.lookup('image-%d' % image_id)
+    if tag != None:
+      tag_table.remove(tag)
+    
+  #public methods
+  def write(self, output, txt, move_cursor, tag_names):
+    transcript = self.transcript
+    if (transcript != None and not 'prompt' in tag_names and
+        not 'footer' in tag_names):
+      transcript.write(output.stream, txt)
+    size = utf8_size(txt)
+    with self._lock:
+      self.bytes_written += size
+    self._queue(('text', output, txt, move_cursor, tuple(tag_names)))
+    
+  def write_more(self, output, result):
+    self._queue(('more', output, result, False, ()))
+    
+  def write_pixbuf(self, output, pixbuf, move_cursor):
+    if self.transcript != None:
+      self.transcript.write('image', '%dx%d' % (pixbuf.get_width(),
+                                                pixbuf.get_height()))
+    #the image is compressed in the calling thread
+    self._queue(('pixbuf', output, self.images.add(pixbuf), move_cursor, ()))
+    
+  def clear(self):
+    self._queue(('clear', None, None, False, ()))
+    
+  def get_result(self, result_id):
+    #the result behind a link or None if it has been released
+    if not result_id in self._results:
+      return None
+    return self._results[result_id][0]
+    
+  def expand_result(self, result_id, text, complete):
+    #inserts the next chunk of a result in front of its link, the link is
+    #removed once the result is complete; only called from the main loop
+    if not result_id in self._results:
+      return
+    textbuffer = self.textview.get_buffer()
+    link = self._link_range(textbuffer, result_id)
+    if link == None:
+      #removed from the scrollback
+      self._release_result(textbuffer, result_id, '')
+      return
+    offset = link[0].get_offset()
+    textbuffer.insert_with_tags_by_name(link[0], text, 'protected')
+    self.index.insert(textbuffer, offset, text, 'stdout')
+    if complete:
+      self._release_result(textbuffer, result_id, '')
+    
+  def has_pending(self):
+    return self._pending != []
+    
+  def set_scrollback_limits(self, max_lines, max_chars):
+    #limits of 0 mean unlimited
+    self.max_lines = max_lines
+    self.max_chars = max_chars
+    with self._lock:
+      self._trim_pending = True
+      self._schedule_flush()
+    
+  def flush(self, budget=None):
+    #insert pending output, consecutive writes with the same tags are
+    #inserted at once; only called from the main loop
+    if budget != None:
+      deadline = time.time() + budget
+    textbuffer = self.textview.get_buffer()
+    outputs = []
+    texts = {}
+    move_cursor = False
+    while True:
+      with self._lock:
+        items = self._pending[:self.batch_size]
+        del self._pending[:self.batch_size]
+      if items == []:
+        break
+      chunks = []
+      chunk_tags = None
+      for kind, output, data, cursor, tag_names in items:
+        if kind == 'text' and tag_names == chunk_tags:
+          chunks.append(data)
+        else:
+          self._insert_text(textbuffer, chunks, chunk_tags)
+          chunks = []
+          chunk_tags = None
+          if kind == 'text':
+            chunks.append(data)
+            chunk_tags = tag_names
+          elif kind == 'pixbuf':
+            self._insert_pixbuf(textbuffer, data)
+          elif kind == 'more':
+            self._insert_more(textbuffer, data)
+          elif kind == 'clear':
+            self.index.clear(textbuffer)
+            textbuffer.set_text('')
+            for result_id in list(self._results.keys()):
+              self._release_result(textbuffer, result_id, '')
+        if output != None:
+          if not output in texts:
+            outputs.append(output)
+            texts[output] = []
+          if kind == 'text':
+            texts[output].append(data)
+        move_cursor = move_cursor or cursor
+      self._insert_text(textbuffer, chunks, chunk_tags)
+      if budget != None and time.time() >= deadline:
+        break
+    if outputs != [] or self._trim_pending:
+      if budget == None:
+        while self._trim(textbuffer, self.trim_chunk):
+          pass
+        self._trim_pending = False
+      else:
+        self._trim_pending = self._trim(textbuffer, self.trim_chunk)
+    if outputs == [] and not move_cursor:
+      return
+    #scroll and move the marks once per flush
+    input_mark = textbuffer.get_mark('input_start')
+    textbuffer.move_mark(input_mark, textbuffer.get_end_iter())
+    if move_cursor:
+      textbuffer.place_cursor(textbuffer.get_end_iter())
+    if True in [output.get_auto_scroll() for output in outputs]:
+      self.textview.scroll_mark_onscreen(input_mark)
+    for output in outputs:
+      if texts[output] != []:
+        output.emit('output-written', ''.join(texts[output]))
     
     
 class GtkInterpreterStandardOutput(GObject.GObject):
   
+  #name of the stream in transcripts
+  stream = 'stdout'
+  
   __gproperties__ = {
                       'auto-scroll': (GObject.TYPE_BOOLEAN, 'auto-scroll',
                                     ('Whether to automatically scroll the ' + 
@@ -46,7 +1423,7 @@ class GtkInterpreterStandardOutput(GObject.GObject):
                                       (GObject.TYPE_STRING,)),
                   }
   
-  def __init__(self, textview):
+  def __init__(self, textview, writer=None):
     super(GtkInterpreterStandardOutput, self).__init__()
     self.textview = textview
     #properties
@@ -55,37 +1432,56 @@ class GtkInterpreterStandardOutput(GObject.GObject):
       textbuffer.create_tag(tag_name='protected', editable=False)
     self._input_mark = textbuffer.get_mark('input_start')
     self._prop_auto_scroll = True
+    #writes are queued and inserted from the main loop, outputs sharing a
+    #textview should share the writer to keep the order of their writes
+    if writer == None:
+      writer = GtkInterpreterOutputWriter(textview)
+    self._writer = writer
     
   def write(self, txt, move_cursor=False, tag_names=['protected']):
-    textbuffer = self.textview.get_buffer()    
-    textiter = textbuffer.get_end_iter()
-    textbuffer.insert_with_tags_by_name(textiter, txt, *tag_names)
-    if self._prop_auto_scroll:
-      self.textview.scroll_mark_onscreen(textbuffer.get_insert())
-    textbuffer.move_mark(self._input_mark, textbuffer.get_end_iter())
-    if move_cursor:
-      textbuffer.place_cursor(textbuffer.get_iter_at_mark(self._input_mark))
-    self.emit('output-written', txt)
+    self._writer.write(self, txt, move_cursor, tag_names)
     
   def write_pixbuf(self, pixbuf, move_cursor=True):
-    textbuffer = self.textview.get_buffer()    
+    self._writer.write_pixbuf(self, pixbuf, move_cursor)
     
-    textbuffer.insert(textbuffer.get_end_iter(), '\n')
-    textbuffer.insert_pixbuf(textbuffer.get_end_iter(), pixbuf)
-    textbuffer.insert(textbuffer.get_end_iter(), '\n')
-    textbuffer.apply_tag_by_name('protected',
-                                  textbuffer.get_iter_at_mark(self._input_mark),
-                                  textbuffer.get_end_iter())     
-    if self._prop_auto_scroll:
-      self.textview.scroll_mark_onscreen(textbuffer.get_insert())
-    textbuffer.move_mark(self._input_mark, textbuffer.get_end_iter())
-    if move_cursor:
-      textbuffer.place_cursor(textbuffer.get_iter_at_mark(self._input_mark))
+  def write_more(self, result):
+    #a link for the rest of a displayed result, see display.ResultDisplay
+    self._writer.write_more(self, result)
+    
+  def flush(self):
+    self._writer.flush()
+    
+  def clear(self):
+    #removes everything written to the textview, in order with the writes
+    self._writer.clear()
       
   def write_image(self, filename, move_cursor=True):
     pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
     self.write_pixbuf(pixbuf, move_cursor)
     
+  def write_pixels(self, data, width, height, rowstride=None, has_alpha=True,
+                   move_cursor=True):
+    #data holds the raw 8 bit RGB(A) samples, e.g. a memoryview of a
+    #renderer's buffer; it is copied once, by GLib.Bytes, into memory the
+    #pixbuf owns, as the renderer may reuse its buffer
+    if rowstride == None:
+      rowstride = width * (4 if has_alpha else 3)
+    if isinstance(data, memoryview):
+      if data.ndim != 1 or data.format != 'B':
+        try:
+          #a flat view of the same memory
+          data = data.cast('B')
+        except (AttributeError, TypeError):
+          #not contiguous
+          data = data.tobytes()
+    elif not isinstance(data, (bytes, bytearray)):
+      data = bytes(data)
+    pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+                                             GdkPixbuf.Colorspace.RGB,
+                                             has_alpha, 8, width, height,
+                                             rowstride)
+    self.write_pixbuf(pixbuf, move_cursor)
+    
   def do_get_property(self, prop):
     if prop.name == 'auto-scroll':
       return self._prop_auto_scroll
@@ -107,14 +1503,16 @@ class GtkInterpreterStandardOutput(GObject.GObject):
     
 class GtkInterpreterErrorOutput(GtkInterpreterStandardOutput):
   
+  stream = 'stderr'
+  
   __gproperties__ = {
                       'color': (GObject.TYPE_STRING, 'color',
                       'Error output color.',
                       '#cc0000', GObject.PARAM_READWRITE),
                     }
   
-  def __init__(self, textview):
-    super(GtkInterpreterErrorOutput, self).__init__(textview)
+  def __init__(self, textview, writer=None):
+    super(GtkInterpreterErrorOutput, self).__init__(textview, writer)
     self._color = '#cc0000'
     self._update_error_tag()
     
@@ -149,33 +1547,202 @@ class GtkInterpreterErrorOutput(GtkInterpreterStandardOutput):
     self.set_property('color', color)
     
     
+class InputAccumulator(object):
+  
+  #collects the lines of a multi-line command; a block is compiled once it
+  #is ended by an empty line, the lines in between are not compiled
+  
+  def __init__(self):
+    super(InputAccumulator, self).__init__()
+    self._lines = []
+    
+  def _opens_block(self, line):
+    #cheap check for first lines that cannot be complete
+    line = line.rstrip()
+    return line.endswith(':') or line.endswith('\\')
+    
+  def push(self, line):
+    #returns the source to compile or None if more lines are needed
+    if self._lines == []:
+      if self._opens_block(line):
+        self._lines.append(line)
+        return None
+      return line
+    self._lines.append(line)
+    if line.strip() != '':
+      return None
+    source = '\n'.join(self._lines) + '\n'
+    self._lines = []
+    return source
+    
+  def set_incomplete(self, source):
+    #the compiler needs more lines, e.g. to close a bracket
+    self._lines = source.rstrip('\n').split('\n')
+    
+  def is_pending(self):
+    return self._lines != []
+    
+  def reset(self):
+    self._lines = []
+    
+    
 class CommandHistory(object):
   
-  def __init__(self, filename=None):
+  #the history file holds one command per line, further lines of multiline
+  #commands are prefixed by a space (commands are stripped, so no command
+  #starts with a space); the file is kept open and flushed every
+  #flush_interval commands
+  flush_interval = 20
+  #search_slice() looks through at most this many characters of indexed
+  #commands, or this many commands added since the index was built
+  slice_size = 1 << 22
+  slice_commands = 10000
+  
+  def __init__(self, filename=None, max_entries=50000):
     super(CommandHistory, self).__init__()
     self._cmds = []
-    self._idx = -1
+    self._idx = 0
     self._filename = filename
-    self._load_from_file()
+    self._max_entries = max_entries
+    self._file = None
+    self._unflushed = 0
+    self._lock = threading.RLock()
+    self._compactor = None
+    self._generation = 0
+    #search index, all indexed commands joined by '\0' and the offsets of
+    #the commands in that string; later commands are searched directly
+    self._corpus = ''
+    self._offsets = []
+    #the file is read in the background; commands added meanwhile are kept
+    #and appended to the file, so only the size it has now is read; up(),
+    #down(), search() and len() wait for it, see is_loaded()
+    self._loader = None
+    if self._filename != None and os.path.exists(self._filename):
+      self._loader = threading.Thread(target=self._load_from_file,
+                                      args=(os.path.getsize(self._filename),
+                                            self._generation))
+      self._loader.daemon = True
+      self._loader.start()
+    _exit_calls[self] = 'close'
     
   #private methods
-  def _load_from_file(self):
-    if self._filename != None and os.path.exists(self._filename):
-      f = open(self._filename, 'r')
-      data = f.read()
+  def _load_from_file(self, size, generation):
+    f = open(self._filename, 'rb')
+    data = f.read(size)
+    f.close()
+    if not isinstance(data, str):
+      data = data.decode('utf-8', 'replace')
+    cmds = self._decode(data)
+    corpus, offsets = self._make_index(cmds)
+    with self._lock:
+      if generation != self._generation:
+        #the history was cleared in the meantime
+        return
+      self._cmds = cmds + self._cmds
+      self._corpus = corpus
+      self._offsets = offsets
+      self._idx = len(self._cmds)
+      cmds = list(self._cmds)
+    if len(cmds) > self._max_entries + self._max_entries // 4:
+      self._run_compaction(cmds, generation)
+      
+  def _ensure_loaded(self):
+    if self._loader != None:
+      self._loader.join()
+      self._loader = None
+      
+  def _decode(self, data):
+    lines = data.split('\n')
+    if not '\n ' in data:
+      return [line for line in lines if line.strip() != '']
+    cmds = []
+    for line in lines:
+      if line.startswith(' ') and cmds != []:
+        cmds[-1] = cmds[-1] + '\n' + line[1:]
+      elif line.strip() != '':
+        cmds.append(line)
+    return cmds
+    
+  def _encode(self, cmd):
+    return cmd.replace('\n', '\n ') + '\n'
+    
+  def _compact(self, cmds):
+    #remove duplicates, keeping the latest occurrence, and old commands
+    seen = set()
+    result = []
+    for cmd in reversed(cmds):
+      if not cmd in seen:
+        seen.add(cmd)
+        result.append(cmd)
+        if len(result) == self._max_entries:
+          break
+    result.reverse()
+    return result
+    
+  def _make_index(self, cmds):
+    offsets = []
+    pos = 1
+    for cmd in cmds:
+      offsets.append(pos)
+      pos += len(cmd) + 1
+    return '\0' + '\0'.join(cmds), offsets
+    
+  def _start_compaction(self):
+    if self._compactor == None:
+      self._compactor = threading.Thread(target=self._run_compaction,
+                                         args=(list(self._cmds),
+                                               self._generation))
+      self._compactor.daemon = True
+      self._compactor.start()
+    
+  def _run_compaction(self, cmds, generation=0):
+    n = len(cmds)
+    cmds = self._compact(cmds)
+    corpus, offsets = self._make_index(cmds)
+    tmp_filename = None
+    if self._filename != None:
+      tmp_filename = self._filename + '.tmp'
+      f = open(tmp_filename, 'w')
+      f.write(''.join([self._encode(cmd) for cmd in cmds]))
       f.close()
-      items = data.split('\n')
-      items = filter(lambda x: x.strip != '', items)
-      self._cmds = items
-      self._idx = len(self._cmds) - 1
+    with self._lock:
+      self._compactor = None
+      if generation != self._generation:
+        #the history was cleared in the meantime
+        if tmp_filename != None:
+          os.remove(tmp_filename)
+        return
+      #commands added in the meantime are kept
+      tail = self._cmds[n:]
+      if tmp_filename != None:
+        self._close_file()
+        f = open(tmp_filename, 'a')
+        f.write(''.join([self._encode(cmd) for cmd in tail]))
+        f.close()
+        os.rename(tmp_filename, self._filename)
+      self._cmds = cmds + tail
+      self._corpus = corpus
+      self._offsets = offsets
+      self._idx = len(self._cmds)
     
   def _add_to_file(self, cmd):
     if self._filename != None:
-      f = open(self._filename, 'a')
-      f.write(cmd + '\n')
-      f.close()
+      if self._file == None:
+        self._file = open(self._filename, 'a')
+      self._file.write(self._encode(cmd))
+      self._unflushed += 1
+      if self._unflushed >= self.flush_interval:
+        self._file.flush()
+        self._unflushed = 0
+        
+  def _close_file(self):
+    if self._file != None:
+      self._file.close()
+      self._file = None
+      self._unflushed = 0
       
   def _clear_file(self):
+    self._close_file()
     if self._filename != None and os.path.exists(self._filename):
       f = open(self._filename, 'w')
       f.write('')
@@ -185,17 +1752,39 @@ class CommandHistory(object):
   def add(self, cmd):
     cmd = cmd.strip()
     if cmd == '': return
-    self._cmds.append(cmd)
-    self._idx = len(self._cmds)
-    self._add_to_file(cmd)
+    with self._lock:
+      if self._cmds == [] or self._cmds[-1] != cmd:
+        self._cmds.append(cmd)
+        self._add_to_file(cmd)
+      self._idx = len(self._cmds)
+      if (self.is_loaded() and
+          len(self._cmds) > self._max_entries + self._max_entries // 4):
+        self._start_compaction()
   
   def clear(self):
-    self._cmds = []
-    self._idx = -1
-    self._clear_file()
+    with self._lock:
+      self._generation += 1
+      self._cmds = []
+      self._idx = 0
+      self._corpus = ''
+      self._offsets = []
+      self._clear_file()
+    
+  def close(self):
+    _exit_calls.pop(self, None)
+    with self._lock:
+      self._close_file()
+      
+  def flush(self):
+    with self._lock:
+      if self._file != None:
+        self._file.flush()
+        self._unflushed = 0
     
   def down(self):
+    self._ensure_loaded()
     if self._cmds == [] or self._idx >= len(self._cmds) - 1:
+      self._idx = len(self._cmds)
       return None
     else:
       self._idx += 1
@@ -203,6 +1792,7 @@ class CommandHistory(object):
       return cmd
     
   def up(self):
+    self._ensure_loaded()
     if self._cmds == [] or self._idx <= 0:
       return None
     else:
@@ -210,41 +1800,219 @@ class CommandHistory(object):
       cmd = self._cmds[self._idx]
       return cmd
       
+  def is_loaded(self):
+    #whether the file has been read, until then up(), down(), search() and
+    #len() block
+    if self._loader != None and self._loader.is_alive():
+      return False
+    self._loader = None
+    return True
+    
+  def search_slice(self, text, before=None, prefix=False):
+    #looks for the latest command before the index before containing (or
+    #starting with) text in a slice of the older commands, newest first;
+    #returns the index and the command, the index the slice stopped at and
+    #None, to be passed as before to continue the search, or None if no
+    #command matches; a slice takes a few milliseconds on any history
+    if text == '':
+      return None
+    self._ensure_loaded()
+    with self._lock:
+      n_indexed = len(self._offsets)
+      if before == None or before > len(self._cmds):
+        before = len(self._cmds)
+      if before > n_indexed:
+        stop = max(n_indexed, before - self.slice_commands)
+        for idx in range(before - 1, stop - 1, -1):
+          cmd = self._cmds[idx]
+          if ((prefix and cmd.startswith(text)) or
+              (not prefix and text in cmd)):
+            return idx, cmd
+        return (stop, None) if stop > 0 else None
+      if before <= 0:
+        return None
+      #whole commands from first on, starting at the '\0' in front of it
+      end = self._offsets[before - 1] + len(self._cmds[before - 1])
+      first = bisect.bisect_left(self._offsets,
+                                 end - self.slice_size, 0, before - 1)
+      start = self._offsets[first] - 1
+      if prefix:
+        pos = self._corpus.rfind('\0' + text, start, end) + 1
+      else:
+        pos = self._corpus.rfind(text, start, end)
+      if pos > 0:
+        idx = bisect.bisect_right(self._offsets, pos) - 1
+        return idx, self._cmds[idx]
+      return (first, None) if first > 0 else None
+      
+  def search(self, text, before=None, prefix=False):
+    #returns the index and the latest command before the index before
+    #containing (or starting with) text, or None
+    while True:
+      res = self.search_slice(text, before, prefix)
+      if res == None or res[1] != None:
+        return res
+      before = res[0]
+      
+  def __len__(self):
+    self._ensure_loaded()
+    return len(self._cmds)
+      
       
 class CommandCompleter(object):
   
-  def __init__(self, local_vars):
+  #global names are kept in a sorted list that is updated from the changes
+  #of the namespace; attribute names are listed without calling user code,
+  #asynchronously by the interpreter if given, and the latest results are
+  #cached for attr_cache_size expressions
+  attr_cache_size = 256
+  #seconds to wait for the attribute names before partial results are used
+  timeout = 0.2
+  
+  def __init__(self, local_vars, interpreter=None):
     super(CommandCompleter, self).__init__()
     self._locals = local_vars
-    self._make_completer()
+    self._interpreter = interpreter
+    self._lister = AttributeLister()
+    self._request = None
+    self._static_names = set(__builtin__.__dict__.keys()) | \
+                         set(keyword.kwlist)
+    self._local_names = set()
+    self._names = sorted(self._static_names)
+    self._attr_cache = OrderedDict()
+    self._matches = []
     self._n = 0
     self._text = ''
+    self.update()
+    
+  #private methods
+  def _prefix_matches(self, names, prefix):
+    matches = []
+    i = bisect.bisect_left(names, prefix)
+    while i < len(names) and names[i].startswith(prefix):
+      matches.append(names[i])
+      i += 1
+    return matches
+    
+  def _global_matches(self, text):
+    matches = []
+    for name in self._prefix_matches(self._names, text):
+      if name in self._locals:
+        value = self._locals[name]
+      else:
+        value = __builtin__.__dict__.get(name)
+      if callable(value) and not keyword.iskeyword(name):
+        name += '('
+      matches.append(name)
+    return matches
+    
+  def _attr_matches(self, expr, attr, names):
+    if not attr.startswith('_'):
+      names = [name for name in self._prefix_matches(names, attr)
+               if not name.startswith('_')]
+    else:
+      names = self._prefix_matches(names, attr)
+    return ['%s.%s' % (expr, name) for name in names]
+    
+  def _cache_attributes(self, expr, names):
+    names = sorted(set(names))
+    self._attr_cache.pop(expr, None)
+    self._attr_cache[expr] = names
+    while len(self._attr_cache) > self.attr_cache_size:
+      self._attr_cache.popitem(False)
+    return names
+    
+  def _request_attributes(self, text, expr, attr, callback):
+    request = {'text': text, 'expr': expr, 'attr': attr,
+               'callback': callback, 'done': False}
+    request['names'] = self._interpreter.list_attributes(expr,
+                                                   self._cb_attributes, request)
+    request['timer'] = GLib.timeout_add(int(self.timeout * 1000),
+                                        self._cb_timeout, request)
+    self._request = request
+    
+  def _cb_attributes(self, names, request):
+    names = self._cache_attributes(request['expr'], names)
+    if not request['done']:
+      GLib.source_remove(request['timer'])
+      self._deliver(request, names)
+    return False
+    
+  def _cb_timeout(self, request):
+    #use what has been collected so far and the cached names
+    if not request['done']:
+      names = set(request['names'])
+      names.update(self._attr_cache.get(request['expr'], []))
+      self._deliver(request, sorted(names))
+    return False
     
-  def _make_completer(self):
-    l = {}
-    l.update(__builtin__.__dict__)
-    l.update(locals())
-    l.update(self._locals)
-    self._completer = Completer(l)
+  def _deliver(self, request, names):
+    request['done'] = True
+    if request is self._request:
+      self._request = None
+      self._matches = self._attr_matches(request['expr'], request['attr'],
+                                         names)
+      self._n = -1
+      request['callback'](request['text'], self._matches)
     
-  def complete_start(self, text):
-    self._make_completer()
+  #public methods
+  def update(self):
+    #applies the changes of the namespace to the name index
+    local_names = set(self._locals.keys())
+    added = local_names - self._local_names
+    removed = (self._local_names - local_names) - self._static_names
+    self._local_names = local_names
+    if len(added) + len(removed) > 64:
+      self._names = sorted(local_names | self._static_names)
+      return
+    for name in removed:
+      i = bisect.bisect_left(self._names, name)
+      if i < len(self._names) and self._names[i] == name:
+        del self._names[i]
+    for name in added:
+      i = bisect.bisect_left(self._names, name)
+      if i == len(self._names) or self._names[i] != name:
+        self._names.insert(i, name)
+    
+  def complete_start(self, text, callback=None):
+    #attribute names are listed asynchronously if callback is given, until
+    #callback(text, matches) is called only cached names are used
     self._text = text
+    self._request = None
+    m = re.match(r'(\w+(\.\w+)*)\.(\w*)$', text)
+    if m != None:
+      expr, attr = m.group(1, 3)
+      if callback != None and self._interpreter != None:
+        names = self._attr_cache.get(expr, [])
+        self._request_attributes(text, expr, attr, callback)
+      else:
+        try:
+          names = self._cache_attributes(expr,
+                                         self._lister.list(self._locals, expr))
+        except Exception:
+          names = []
+      self._matches = self._attr_matches(expr, attr, names)
+    elif '.' in text:
+      self._matches = []
+    else:
+      self._matches = self._global_matches(text)
     self._n = -1
     return self.complete()
     
   def complete(self):
     self._n += 1
-    suggest = self._completer.complete(self._text, self._n)
-    return suggest
+    if self._n < len(self._matches):
+      return self._matches[self._n]
+    return None
     
   def complete_back(self):
     self._n -= 1
     if self._n < 0:
       self._n = 0
       return None
-    suggest = self._completer.complete(self._text, self._n)
-    return suggest
+    if self._n < len(self._matches):
+      return self._matches[self._n]
+    return None
 
 
 class GtkPyInterpreterWidget(Gtk.VBox):
@@ -268,6 +2036,91 @@ class GtkPyInterpreterWidget(Gtk.VBox):
                                           'Error text color.',
                                           '#cc0000',
                                           GObject.PARAM_READWRITE),                 
+                      'timing-footer':    (GObject.TYPE_BOOLEAN, 'timing-footer',
+                                          ('Whether to write the time ' +
+                                          'used by each command to the ' +
+                                          'output'),
+                                          False, GObject.PARAM_READWRITE),
+                      'memory-profiling': (GObject.TYPE_BOOLEAN,
+                                          'memory-profiling',
+                                          ('Whether to measure the memory ' +
+                                          'allocated by each command'),
+                                          False, GObject.PARAM_READWRITE),
+                      'fd-capture':       (GObject.TYPE_BOOLEAN, 'fd-capture',
+                                          ('Whether to show what commands ' +
+                                          'write to the file descriptors ' +
+                                          '1 and 2, e.g. the output of ' +
+                                          'extension modules'),
+                                          False, GObject.PARAM_READWRITE),
+                      'wall-time-budget': (GObject.TYPE_DOUBLE,
+                                          'wall-time-budget',
+                                          ('Seconds a command may run ' +
+                                          'before it is interrupted, 0 for ' +
+                                          'no limit'),
+                                          0, GObject.G_MAXDOUBLE, 0,
+                                          GObject.PARAM_READWRITE),
+                      'cpu-time-budget':  (GObject.TYPE_DOUBLE,
+                                          'cpu-time-budget',
+                                          ('Seconds of CPU time a command ' +
+                                          'may use before it is ' +
+                                          'interrupted, 0 for no limit'),
+                                          0, GObject.G_MAXDOUBLE, 0,
+                                          GObject.PARAM_READWRITE),
+                      'memory-budget':    (GObject.TYPE_INT64,
+                                          'memory-budget',
+                                          ('Bytes the resident memory may ' +
+                                          'grow by during a command before ' +
+                                          'it is interrupted, 0 for no ' +
+                                          'limit'),
+                                          0, GObject.G_MAXINT64, 0,
+                                          GObject.PARAM_READWRITE),
+                      'session-directory':
+                                          (GObject.TYPE_STRING,
+                                          'session-directory',
+                                          ('Directory save_session and ' +
+                                          'load_session use by default'),
+                                          None, GObject.PARAM_READWRITE),
+                      'session-autosave': (GObject.TYPE_DOUBLE,
+                                          'session-autosave',
+                                          ('Seconds the console has to be ' +
+                                          'idle before the session is ' +
+                                          'saved to the session directory, ' +
+                                          '0 for no autosave'),
+                                          0, GObject.G_MAXDOUBLE, 0,
+                                          GObject.PARAM_READWRITE),
+                      'image-memory':     (GObject.TYPE_INT64, 'image-memory',
+                                          ('Bytes used by the images in ' +
+                                          'the output'),
+                                          0, GObject.G_MAXINT64, 0,
+                                          GObject.PARAM_READABLE),
+                      'image-cache-size': (GObject.TYPE_INT64,
+                                          'image-cache-size',
+                                          ('Maximum number of bytes used ' +
+                                          'for the compressed full ' +
+                                          'resolution images'),
+                                          0, GObject.G_MAXINT64,
+                                          32 * 1024 * 1024,
+                                          GObject.PARAM_READWRITE),
+                      'completion-timeout': (GObject.TYPE_INT,
+                                          'completion-timeout',
+                                          ('Milliseconds to wait for ' +
+                                          'attribute completions before ' +
+                                          'partial results are shown'),
+                                          0, 60000, 200,
+                                          GObject.PARAM_READWRITE),
+                      'max-scrollback-lines': (GObject.TYPE_INT,
+                                          'max-scrollback-lines',
+                                          ('Maximum number of lines kept ' +
+                                          'in the output, 0 for no limit'),
+                                          0, GObject.G_MAXINT, 0,
+                                          GObject.PARAM_READWRITE),
+                      'max-scrollback-chars': (GObject.TYPE_INT,
+                                          'max-scrollback-chars',
+                                          ('Maximum number of characters ' +
+                                          'kept in the output, 0 for no ' +
+                                          'limit'),
+                                          0, GObject.G_MAXINT, 0,
+                                          GObject.PARAM_READWRITE),
                     }
                     
   __gsignals__ = {
@@ -277,25 +2130,54 @@ class GtkPyInterpreterWidget(Gtk.VBox):
                   'stderr-written' : (GObject.SIGNAL_RUN_LAST,
                                       GObject.TYPE_NONE,
                                       (GObject.TYPE_STRING,)),
+                  #source
+                  'command-started' : (GObject.SIGNAL_RUN_LAST,
+                                       GObject.TYPE_NONE,
+                                       (GObject.TYPE_STRING,)),
+                  #source, wall time, cpu time, output bytes, name of the
+                  #exception or an empty string
+                  'command-finished' : (GObject.SIGNAL_RUN_LAST,
+                                        GObject.TYPE_NONE,
+                                        (GObject.TYPE_STRING,
+                                         GObject.TYPE_DOUBLE,
+                                         GObject.TYPE_DOUBLE,
+                                         GObject.TYPE_INT64,
+                                         GObject.TYPE_STRING)),
                   }
   
   name = '__console__'
   line_start = '>>> '
   banner = '\nWelcome to the GtkPyInterpreterWidget :-)'
   
-  def __init__(self, interpreter_locals={}, history_fn=None):
+  def __init__(self, interpreter_locals=None, history_fn=None, threaded=False,
+               backend=GtkInterpreter):
+    #interpreter_locals becomes the namespace of the interpreter, values may
+    #be lazy.Lazy placeholders that are resolved on first use
     super(GtkPyInterpreterWidget, self).__init__()
+    if interpreter_locals == None:
+      interpreter_locals = {}
     #properties
     self._prop_auto_scroll = True
     self._prop_font = 'sans 10'
     self._prop_margins = 8
-    self._prev_cmd = []
-    self._pause_interpret = False
+    self._prop_timing_footer = False
+    self._prop_memory_profiling = False
+    self._prop_fd_capture = False
+    self._prop_wall_time_budget = 0
+    self._prop_cpu_time_budget = 0
+    self._prop_memory_budget = 0
+    self._prop_session_directory = None
+    self._prop_session_autosave = 0
+    self._autosave_id = None
+    self._memory_timeline = MemoryTimeline()
+    self._statistics = None
+    self._output_start = 0
+    self._input = InputAccumulator()
     self._prev_key = -1
+    self._search = None
+    self._history_loading_id = None
     #history
     self._history = CommandHistory(history_fn)
-    #completer
-    self._completer = CommandCompleter(interpreter_locals)
     #output
     sw = Gtk.ScrolledWindow()
     self.output = Gtk.TextView()
@@ -307,12 +2189,59 @@ class GtkPyInterpreterWidget(Gtk.VBox):
     textbuffer = self.output.get_buffer()
     self._input_mark = textbuffer.create_mark('input_start',
                                               textbuffer.get_start_iter(), True)
+    textbuffer.create_tag(tag_name='footer', foreground='#888888')
+    textbuffer.create_tag(tag_name='prompt')
+    textbuffer.create_tag(tag_name='find-match', background='#fce94f')
+    textbuffer.create_tag(tag_name='find-current', background='#fcaf3e')
     sw.add(self.output)
     self.pack_start(sw, True, True, 0)
     self.output.connect('event', self._cb_textview_event)
+    self.output.connect('populate-popup', self._cb_populate_popup)
+    self._clicked_image = None
+    #find bar, the matches are highlighted in the visible region only
+    self._find_matches = []
+    self._find_current = None
+    self._find_shown = []
+    self._find_generation = 0
+    self._find_idle_id = None
+    self._find_bar = Gtk.HBox(spacing=4)
+    self._find_entry = Gtk.Entry()
+    self._find_entry.connect('changed', self._cb_find_changed)
+    self._find_entry.connect('activate', self._cb_find_next, 1)
+    self._find_entry.connect('key-press-event', self._cb_find_key)
+    self._find_bar.pack_start(self._find_entry, True, True, 0)
+    for label, step in [('Previous', -1), ('Next', 1)]:
+      button = Gtk.Button(label=label)
+      button.connect('clicked', self._cb_find_next, step)
+      self._find_bar.pack_start(button, False, False, 0)
+    self._find_regex = Gtk.CheckButton(label='Regex')
+    self._find_regex.connect('toggled', self._cb_find_changed)
+    self._find_bar.pack_start(self._find_regex, False, False, 0)
+    self._find_case = Gtk.CheckButton(label='Match case')
+    self._find_case.connect('toggled', self._cb_find_changed)
+    self._find_bar.pack_start(self._find_case, False, False, 0)
+    self._find_errors = Gtk.CheckButton(label='Errors only')
+    self._find_errors.connect('toggled', self._cb_find_changed)
+    self._find_bar.pack_start(self._find_errors, False, False, 0)
+    self._find_label = Gtk.Label()
+    self._find_bar.pack_start(self._find_label, False, False, 0)
+    button = Gtk.Button(label='Close')
+    button.connect('clicked', lambda button: self.hide_find_bar())
+    self._find_bar.pack_start(button, False, False, 0)
+    for child in self._find_bar.get_children():
+      child.show()
+    self._find_bar.set_no_show_all(True)
+    self.pack_start(self._find_bar, False, False, 0)
+    sw.get_vadjustment().connect('value-changed', self._cb_find_scrolled)
+    #status line, e.g. for the history search
+    self._status = Gtk.Label()
+    self._status.set_alignment(0, 0.5)
+    self._status.set_no_show_all(True)
+    self.pack_start(self._status, False, False, 0)
     #in and out
-    self.gtk_stdout = GtkInterpreterStandardOutput(self.output)
-    self.gtk_stderr = GtkInterpreterErrorOutput(self.output)
+    self._writer = GtkInterpreterOutputWriter(self.output)
+    self.gtk_stdout = GtkInterpreterStandardOutput(self.output, self._writer)
+    self.gtk_stderr = GtkInterpreterErrorOutput(self.output, self._writer)
     #locals
     if not '__name__' in interpreter_locals:
       interpreter_locals['__name__'] = self.name
@@ -324,18 +2253,66 @@ class GtkPyInterpreterWidget(Gtk.VBox):
     interpreter_locals['stdout'] = self.gtk_stdout
     interpreter_locals['stderr'] = self.gtk_stderr
     #interpreter
-    self.interpreter = GtkInterpreter(self.gtk_stdout, self.gtk_stderr,
-                                      interpreter_locals)
+    if threaded:
+      GObject.threads_init()
+    self.interpreter = backend(self.gtk_stdout, self.gtk_stderr,
+                               interpreter_locals, threaded,
+                               self._cb_interpreter_finished)
+    self.connect('destroy', self._cb_destroy)
+    self.interpreter.add_pre_execute_hook(self._cb_interpreter_started)
+    #completer
+    self._completer = CommandCompleter(self.interpreter.locals,
+                                       self.interpreter)
+    self._completion_menu = None
     self.gtk_stdout.connect('output-written', self._cb_stdout_written)
     self.gtk_stderr.connect('output-written', self._cb_stderr_written)
     #write banner to output
-    self.gtk_stdout.write(self.banner + '\n\n' + self.line_start)
+    self.gtk_stdout.write(self.banner + '\n\n')
+    self._write_prompt(self.line_start, False)
     
   #callbacks     
   def _cb_textview_event(self, textview, event):
     if event.type == Gdk.EventType.KEY_PRESS:
+      if (event.keyval in [70, 102] and
+          event.state & Gdk.ModifierType.CONTROL_MASK):
+        #Ctrl-F, also while a command is running
+        self.show_find_bar()
+        return True
+      if (event.keyval in [67, 99] and
+          event.state & Gdk.ModifierType.CONTROL_MASK and
+          self.interpreter.is_busy() and
+          not textview.get_buffer().get_has_selection()):
+        #Ctrl-C interrupts the running command unless text is to be copied
+        if not self.interpreter.interrupt():
+          self.gtk_stderr.write('The command cannot be interrupted.\n')
+        return True
+      if self.interpreter.is_busy():
+        #a command is running, the textview is not editable until it returns
+        return False
+      if self._writer.has_pending():
+        #the input line has to be up to date before handling the key
+        self._writer.flush()
+      if self._search != None and self._search_key(event):
+        return True
       textbuffer = textview.get_buffer()
-      if event.keyval == 65362:
+      if ((event.keyval in [65362, 65364] or
+           (event.keyval == 114 and
+            event.state & Gdk.ModifierType.CONTROL_MASK)) and
+          not self._history.is_loaded()):
+        #the history file is still being read
+        self._show_history_loading()
+        return True
+      if (event.keyval == 114 and
+          event.state & Gdk.ModifierType.CONTROL_MASK):
+        #Ctrl-R, reverse incremental history search
+        start_iter = textbuffer.get_iter_at_mark(self._input_mark)
+        end_iter = textbuffer.get_end_iter()
+        self._search = {'query': '', 'idx': None,
+                        'line': textbuffer.get_text(start_iter, end_iter,
+                                                    True)}
+        self._search_update()
+        return True
+      elif event.keyval == 65362:
         #up
         cmd = self._history.up()
         if cmd != None:
@@ -363,12 +2340,23 @@ class GtkPyInterpreterWidget(Gtk.VBox):
         return True
       elif event.keyval == 65293:
         #return
-        start_iter = textbuffer.get_iter_at_mark(self._input_mark)
-        end_iter = textbuffer.get_end_iter()
-        txt = textbuffer.get_text(start_iter, end_iter, True)
-        textbuffer.apply_tag_by_name('protected', start_iter, end_iter)
-        textbuffer.insert(textbuffer.get_end_iter(), '\n')
-        self._cmd_receive(txt)
+        self._submit_input()
+        self._prev_key = event.keyval
+        return True
+      elif ((event.keyval in [86, 118] and
+             event.state & Gdk.ModifierType.CONTROL_MASK) or
+            (event.keyval == 65379 and
+             event.state & Gdk.ModifierType.SHIFT_MASK)):
+        #Ctrl-V or Shift-Insert, multi-line text is run as a block
+        text = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD).wait_for_text()
+        if (text == None or not '\n' in text.strip() or
+            self._input.is_pending()):
+          return False
+        cursor = textbuffer.get_iter_at_mark(textbuffer.get_insert())
+        if cursor.compare(textbuffer.get_iter_at_mark(self._input_mark)) < 0:
+          textbuffer.place_cursor(textbuffer.get_end_iter())
+        textbuffer.insert_at_cursor(text.rstrip())
+        self._submit_input()
         self._prev_key = event.keyval
         return True
       elif event.keyval == 65360:
@@ -388,7 +2376,7 @@ class GtkPyInterpreterWidget(Gtk.VBox):
         end_iter = textbuffer.get_end_iter()
         txt = textbuffer.get_text(start_iter, end_iter, True)
         if not self._prev_key in [65056, 65289]:
-          suggest = self._completer.complete_start(txt)
+          suggest = self._completer.complete_start(txt, self._cb_completions)
         else:
           suggest = self._completer.complete()
         self._prev_key = event.keyval
@@ -424,47 +2412,519 @@ class GtkPyInterpreterWidget(Gtk.VBox):
         pass
       else:
         self._prev_key = event.keyval
+    elif event.type in [Gdk.EventType.BUTTON_PRESS,
+                        Gdk.EventType._2BUTTON_PRESS]:
+      #remember the image under the pointer for the context menu, a double
+      #click opens it
+      x, y = textview.window_to_buffer_coords(Gtk.TextWindowType.TEXT,
+                                              int(event.x), int(event.y))
+      self._clicked_image = self._image_at(x, y)
+      if (event.type == Gdk.EventType._2BUTTON_PRESS and
+          self._clicked_image != None):
+        self.show_image(self._clicked_image)
+        return True
+      result_id = self._tag_id_at(x, y, 'more-')
+      if (event.type == Gdk.EventType.BUTTON_PRESS and event.button == 1 and
+          result_id != None):
+        self._expand_result(result_id)
+        return True
+        
+  def _cb_populate_popup(self, textview, menu):
+    if self._clicked_image != None:
+      image_id = self._clicked_image
+      menu.append(Gtk.SeparatorMenuItem())
+      item = Gtk.MenuItem(label='Open image')
+      item.connect('activate', self._cb_image_open, image_id)
+      menu.append(item)
+      item = Gtk.MenuItem(label='Save image as...')
+      item.connect('activate', self._cb_image_save, image_id)
+      menu.append(item)
+      menu.show_all()
+      
+  def _cb_image_open(self, item, image_id):
+    self.show_image(image_id)
+    
+  def _cb_image_save(self, item, image_id):
+    dialog = Gtk.FileChooserDialog('Save image', self.get_toplevel(),
+                                   Gtk.FileChooserAction.SAVE,
+                                   (Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                                    Gtk.STOCK_SAVE, Gtk.ResponseType.OK))
+    dialog.set_do_overwrite_confirmation(True)
+    dialog.set_current_name('image-%d.png' % image_id)
+    if dialog.run() == Gtk.ResponseType.OK:
+      if not self.save_image(image_id, dialog.get_filename()):
+        #removed from the output while the dialog was open
+        self._status.set_text('Image %d is no longer available' % image_id)
+        self._status.show()
+    dialog.destroy()
         
   def _cb_stdout_written(self, stdout, text):
     self.emit('stdout-written', text)
     
   def _cb_stderr_written(self, stderr, text):
     self.emit('stderr-written', text)
+    
+  def _cb_completions(self, text, matches):
+    #asynchronous attribute completions, ignored if the input has changed
+    textbuffer = self.output.get_buffer()
+    start_iter = textbuffer.get_iter_at_mark(self._input_mark)
+    end_iter = textbuffer.get_end_iter()
+    if textbuffer.get_text(start_iter, end_iter, True) != text:
+      return
+    if len(matches) == 1:
+      self._replace_input(matches[0])
+    elif len(matches) > 1:
+      self._completion_menu = Gtk.Menu()
+      for match in matches[:100]:
+        item = Gtk.MenuItem(label=match)
+        item.connect('activate', self._cb_completion_activate, match)
+        self._completion_menu.append(item)
+      self._completion_menu.show_all()
+      self._completion_menu.popup(None, None, None, None, 0,
+                                  Gtk.get_current_event_time())
+      
+  def _cb_completion_activate(self, item, match):
+    self._replace_input(match)
+    
+  def _cb_destroy(self, widget):
+    self._cancel_autosave()
+    if self._search != None:
+      self._search_end()
+    if self._history_loading_id != None:
+      GLib.source_remove(self._history_loading_id)
+      self._history_loading_id = None
+    self.stop_transcript()
+    self.interpreter.shutdown()
+    
+  def _cb_find_changed(self, widget):
+    self._find_start()
+    
+  def _cb_find_key(self, entry, event):
+    if event.keyval == 65307:
+      #Escape
+      self.hide_find_bar()
+      return True
+    elif (event.keyval == 65293 and
+          event.state & Gdk.ModifierType.SHIFT_MASK):
+      #Shift-Return
+      self._cb_find_next(entry, -1)
+      return True
+    return False
+    
+  def _cb_find_next(self, widget, step):
+    if self._find_current == None:
+      return
+    #matches removed from the output are skipped
+    first = self._find_search(-1)
+    if first == len(self._find_matches):
+      self._find_label.set_text('No matches')
+      return
+    i = max(self._find_current, first) - first + step
+    self._find_select(first + i % (len(self._find_matches) - first))
+      
+  def _cb_find_scrolled(self, adjustment):
+    if self._find_matches != [] and self._find_idle_id == None:
+      self._find_idle_id = GLib.idle_add(self._cb_find_highlight)
+      
+  def _cb_find_highlight(self):
+    self._find_idle_id = None
+    self._find_highlight()
+    return False
+    
+  def _cb_find_done(self, generation, matches):
+    if generation != self._find_generation:
+      #the query has changed in the meantime
+      return False
+    self._find_matches = [match for match in matches
+                          if not match[0].get_deleted()]
+    if self._find_matches == []:
+      self._find_label.set_text('No matches')
+      return False
+    #start at the first match in the visible region
+    i = self._find_search(self._visible_range()[0])
+    self._find_select(i if i < len(self._find_matches) else 0)
+    return False
+    
+  def _cb_result_expanded(self, text, complete, result_id):
+    self._writer.expand_result(result_id, text, complete)
+    
+  def _cb_interpreter_started(self):
+    self._cancel_autosave()
+    self._output_start = self._writer.bytes_written
+    self.emit('command-started', self.interpreter.last_source)
+    
+  def _cb_block_progress(self, i, n):
+    self._status.set_text('Running statement %d of %d' % (i + 1, n))
+    self._status.show()
+    return False
+    
+  def _cb_interpreter_finished(self):
+    if self._search == None:
+      self._status.hide()
+    self._command_finished()
+    self._completer.update()
+    self._schedule_autosave()
+    if not self.output.get_editable():
+      #the prompt was held back while the command was running
+      self.output.set_editable(True)
+      self._write_prompt(self.line_start)
       
+  def _cb_autosave(self):
+    self._autosave_id = None
+    if not self.is_busy() and self._prop_session_directory != None:
+      self.interpreter.save_session(self._prop_session_directory,
+                                    self._cb_session_autosaved)
+    return False
+    
+  def _cb_session_autosaved(self, summary, error):
+    if error != None:
+      self._status.set_text('Autosave failed: %s' % error)
+      self._status.show()
+    
   #private methods    
+  def _schedule_autosave(self):
+    #the session is saved once no command has been run for the autosave
+    #delay
+    self._cancel_autosave()
+    if (self._prop_session_autosave > 0 and
+        self._prop_session_directory != None):
+      self._autosave_id = GLib.timeout_add(
+          int(self._prop_session_autosave * 1000), self._cb_autosave)
+    
+  def _cancel_autosave(self):
+    if self._autosave_id != None:
+      GLib.source_remove(self._autosave_id)
+      self._autosave_id = None
+    
   def _clear(self):
-    self.output.get_buffer().set_text('')
+    #queued like any other output to keep the order of writes
+    self._writer.clear()
+    
+  def _find_start(self):
+    #searches the output in a thread, the results are delivered to
+    #_cb_find_done
+    self._find_generation += 1
+    self._find_unhighlight()
+    self._find_matches = []
+    self._find_current = None
+    query = self._find_entry.get_text()
+    if query == '':
+      self._find_label.set_text('')
+      return
+    flags = re.MULTILINE
+    if not self._find_case.get_active():
+      flags |= re.IGNORECASE
+    try:
+      if self._find_regex.get_active():
+        expression = re.compile(query, flags)
+      else:
+        expression = re.compile(re.escape(query), flags)
+    except re.error:
+      self._find_label.set_text('Invalid pattern')
+      return
+    self._writer.flush()
+    stream = 'stderr' if self._find_errors.get_active() else None
+    self._find_label.set_text('Searching...')
+    thread = threading.Thread(target=self._find_run,
+                              args=(self._find_generation,
+                                    self._writer.index.snapshot(),
+                                    expression, stream))
+    thread.daemon = True
+    thread.start()
+    
+  def _find_run(self, generation, chunks, expression, stream):
+    matches = self._writer.index.search(chunks, expression, stream)
+    GLib.idle_add(self._cb_find_done, generation, matches)
+    
+  def _find_offset(self, i):
+    #None if the match has been removed from the output
+    mark, offset, length = self._find_matches[i]
+    if mark.get_deleted():
+      return None
+    return self.output.get_buffer().get_iter_at_mark(mark).get_offset() + offset
+    
+  def _find_search(self, offset):
+    #index of the first match ending after offset; the matches are sorted
+    #and only the oldest ones can have been removed
+    low = 0
+    high = len(self._find_matches)
+    while low < high:
+      middle = (low + high) // 2
+      start = self._find_offset(middle)
+      if start == None or start + self._find_matches[middle][2] <= offset:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+    
+  def _find_iters(self, i):
+    textbuffer = self.output.get_buffer()
+    start = self._find_offset(i)
+    return (textbuffer.get_iter_at_offset(start),
+            textbuffer.get_iter_at_offset(start + self._find_matches[i][2]))
+    
+  def _find_select(self, i):
+    self._find_current = i
+    first = self._find_search(-1)
+    self._find_label.set_text('%d of %d' % (i - first + 1,
+                                            len(self._find_matches) - first))
+    start_iter, end_iter = self._find_iters(i)
+    self.output.scroll_to_iter(start_iter, 0.1, False, 0, 0)
+    self._find_highlight()
+    
+  def _find_highlight(self):
+    self._find_unhighlight()
+    if self._find_matches == []:
+      return
+    textbuffer = self.output.get_buffer()
+    top, bottom = self._visible_range()
+    i = self._find_search(top)
+    while i < len(self._find_matches) and self._find_offset(i) <= bottom:
+      start_iter, end_iter = self._find_iters(i)
+      if i == self._find_current:
+        textbuffer.apply_tag_by_name('find-current', start_iter, end_iter)
+      else:
+        textbuffer.apply_tag_by_name('find-match', start_iter, end_iter)
+      self._find_shown.append(i)
+      i += 1
+      
+  def _find_unhighlight(self):
+    textbuffer = self.output.get_buffer()
+    for i in self._find_shown:
+      if self._find_offset(i) != None:
+        start_iter, end_iter = self._find_iters(i)
+        textbuffer.remove_tag_by_name('find-match', start_iter, end_iter)
+        textbuffer.remove_tag_by_name('find-current', start_iter, end_iter)
+    self._find_shown = []
+    
+  def _visible_range(self):
+    #offsets of the first and the last visible character
+    rect = self.output.get_visible_rect()
+    offsets = []
+    for x, y in [(rect.x, rect.y),
+                 (rect.x + rect.width, rect.y + rect.height)]:
+      textiter = self.output.get_iter_at_location(x, y)
+      if isinstance(textiter, tuple):
+        textiter = textiter[1]
+      offsets.append(textiter.get_offset())
+    return offsets
+    
+  def _expand_result(self, result_id):
+    #the value may be changed by a running command
+    result = self._writer.get_result(result_id)
+    if result != None and not self.is_busy():
+      self.interpreter.expand_result(result, self._cb_result_expanded,
+                                     result_id)
+    
+  def _image_at(self, x, y):
+    #id of the image at the buffer coordinates or None
+    return self._tag_id_at(x, y, 'image-')
+    
+  def _tag_id_at(self, x, y, prefix):
+    #id of the tag named prefix + id at the buffer coordinates or None
+    textiter = self.output.get_iter_at_location(x, y)
+    if isinstance(textiter, tuple):
+      #newer Gtk versions return whether there is an iter at all
+      if not textiter[0]:
+        return None
+      textiter = textiter[1]
+    for tag in textiter.get_tags():
+      name = tag.get_property('name')
+      if name != None and name.startswith(prefix):
+        return int(name[len(prefix):])
+    return None
+    
+  def _replace_input(self, txt):
+    textbuffer = self.output.get_buffer()
+    start_iter = textbuffer.get_iter_at_mark(self._input_mark)
+    end_iter = textbuffer.get_end_iter()
+    textbuffer.delete(start_iter, end_iter)
+    start_iter = textbuffer.get_iter_at_mark(self._input_mark)
+    textbuffer.insert(start_iter, txt)
+    
+  def _search_key(self, event):
+    #handles a key press during the history search, returns False if the
+    #search was ended and the key has to be handled as usual
+    control = event.state & Gdk.ModifierType.CONTROL_MASK
+    char = Gdk.keyval_to_unicode(event.keyval)
+    if event.keyval == 114 and control:
+      #Ctrl-R, look for an older match
+      self._search_update(self._search['idx'])
+    elif event.keyval == 65307:
+      #Escape, restore the input line
+      self._replace_input(self._search['line'])
+      self._search_end()
+    elif event.keyval == 65288:
+      #BackSpace
+      self._search['query'] = self._search['query'][:-1]
+      self._search_update()
+    elif event.keyval in [65293, 65421]:
+      #Return or keypad Enter, run the match shown in the input line
+      self._search_end()
+      self._submit_input()
+      self._prev_key = event.keyval
+    elif char >= 32 and char != 127 and not control:
+      #a printable character, Tab and Delete end the search; a longer query
+      #can only match at or before the current match
+      self._search['query'] += event.string
+      idx = self._search['idx']
+      self._search_update(idx + 1 if idx != None else None)
+    elif event.keyval in [65505, 65507]:
+      #Shift and Control modifiers
+      pass
+    else:
+      self._search_end()
+      return False
+    return True
+    
+  def _show_history_loading(self):
+    self._status.set_text('loading history...')
+    self._status.show()
+    if self._history_loading_id == None:
+      self._history_loading_id = GLib.timeout_add(100,
+                                                  self._cb_history_loaded)
+    
+  def _cb_history_loaded(self):
+    if not self._history.is_loaded():
+      return True
+    self._history_loading_id = None
+    if self._status.get_text() == 'loading history...':
+      self._status.hide()
+    return False
+    
+  def _cb_search_continue(self, before):
+    self._search['source_id'] = None
+    self._search_update(before)
+    return False
+    
+  def _search_update(self, before=None):
+    #the history is searched in slices, the next one once the key presses
+    #waiting meanwhile have been handled
+    if self._search.get('source_id') != None:
+      GLib.source_remove(self._search['source_id'])
+      self._search['source_id'] = None
+    query = self._search['query']
+    res = self._history.search_slice(query, before)
+    if res != None and res[1] == None:
+      self._status.set_text("reverse-i-search (searching): '%s'" % query)
+      self._search['source_id'] = GLib.idle_add(self._cb_search_continue,
+                                                res[0])
+    elif res != None:
+      self._search['idx'] = res[0]
+      self._replace_input(res[1])
+      self._status.set_text("reverse-i-search: '%s'" % query)
+    elif query != '':
+      self._status.set_text("failing reverse-i-search: '%s'" % query)
+    else:
+      self._status.set_text("reverse-i-search: ''")
+    self._status.show()
+    
+  def _search_end(self):
+    if self._search.get('source_id') != None:
+      GLib.source_remove(self._search['source_id'])
+    self._search = None
+    self._status.hide()
+    
+  def _command_finished(self):
+    stats = self.interpreter.last_stats
+    source = self.interpreter.last_source
+    output_bytes = self._writer.bytes_written - self._output_start
+    if self._statistics != None:
+      self._statistics.add(source, stats['wall'], stats['cpu'], output_bytes,
+                           stats['exception'])
+    self.emit('command-finished', source, stats['wall'], stats['cpu'],
+              output_bytes, stats['exception'] or '')
+    if self._prop_timing_footer:
+      footer = '[wall %.3f s, cpu %.3f s, %d bytes output' % (stats['wall'],
+                                                              stats['cpu'],
+                                                              output_bytes)
+      if stats['exception'] != None:
+        footer += ', ' + stats['exception']
+      self.gtk_stdout.write(footer + ']\n', False, ['protected', 'footer'])
+    if stats.get('memory') != None:
+      self._memory_timeline.add(source, stats['memory'])
+      self._write_memory_report(stats['memory'])
+      
+  def _write_memory_report(self, memory):
+    report = '[memory %s' % format_size(memory['delta'])
+    if memory['traced'] != None:
+      report += ', resident %s' % format_size(memory['rss_delta'])
+    for site, size, count in memory['top']:
+      report += '\n  %s: %s in %+d blocks' % (site, format_size(size), count)
+    self.gtk_stdout.write(report + ']\n', False, ['protected', 'footer'])
+      
+  def _submit_input(self):
+    textbuffer = self.output.get_buffer()
+    start_iter = textbuffer.get_iter_at_mark(self._input_mark)
+    end_iter = textbuffer.get_end_iter()
+    txt = textbuffer.get_text(start_iter, end_iter, True)
+    textbuffer.apply_tag_by_name('protected', start_iter, end_iter)
+    textbuffer.insert(textbuffer.get_end_iter(), '\n')
+    self._record_input(txt)
+    self._cmd_receive(txt)
+    
+  def _record_input(self, txt):
+    if self._writer.transcript != None:
+      self._writer.transcript.write('input', txt)
+    
+  def _run_session_magic(self, name, path):
+    if self.is_busy():
+      return False
+    if path == None:
+      path = self._prop_session_directory
+    if path == None:
+      raise ValueError('no session directory')
+    self.set_property('session-directory', path)
+    self._writer.flush()
+    self._input.reset()
+    self._replace_input('%%%s %s' % (name, path))
+    self._submit_input()
+    return True
+    
+  def _run_block(self, source, filename, symbol='single'):
+    self.interpreter.runblock(source, filename, self._cb_block_progress,
+                              symbol)
+    self._cmd_started(self.line_start)
     
   def _cmd_receive(self, cmd):
     #add to history
     self._history.add(cmd)
-    #add output
-    line_start = '' if self._prev_cmd != [] else self.line_start
-    #interpret command
-    if not self._pause_interpret:
-      res = self.interpreter.runsource(cmd)
-      self.interpreter.showsyntaxerror()
-    else:
-      res = False
-    if res == True:
+    if '\n' in cmd.strip() and not self._input.is_pending():
+      #pasted or recalled from the history
+      self._run_block(cmd, '<input>')
+      return
+    magic = self.interpreter.magics.parse(cmd)
+    if magic != None and not self._input.is_pending():
+      if self.interpreter.magics.has_magic(magic[0]):
+        self.interpreter.runmagic(cmd, *magic)
+      else:
+        self.gtk_stderr.write('Unknown magic command %%%s, available: %s\n' %
+                              (magic[0], ', '.join(
+                                  ['%' + name for name in
+                                   self.interpreter.magics.get_names()])))
+      self._cmd_started(self.line_start)
+      return
+    #interpret command, each complete block is compiled once
+    source = self._input.push(cmd)
+    if source != None and self.interpreter.runsource(source):
+      self._input.set_incomplete(source)
+      source = None
+    if source == None:
       #wait for more input
-      self.gtk_stdout.write('...', True)
-      self._prev_cmd.append(cmd)
-      self._pause_interpret = True
+      self._write_prompt('...')
     else:
-      if self._prev_cmd != [] and cmd.strip() == '':
-        #compile multiline input
-        self._prev_cmd.append(cmd)
-        ncmd = '\n'.join(self._prev_cmd) + '\n'
-        res = self.interpreter.runsource(ncmd)
-        self._prev_cmd = []
-        self._pause_interpret = False
-      elif self._prev_cmd != []:
-        self.gtk_stdout.write('...')
-        self._prev_cmd.append(cmd)
-      else:
-        self._prev_cmd = []
-        self.gtk_stdout.write(line_start, True)
+      self._cmd_started(self.line_start)
+        
+  def _cmd_started(self, line_start):
+    if self.interpreter.is_busy():
+      #the command runs in the background, the prompt is written when it
+      #has finished
+      self.output.set_editable(False)
+    else:
+      self._write_prompt(line_start)
+      
+  def _write_prompt(self, prompt, move_cursor=True):
+    self.gtk_stdout.write(prompt, move_cursor, ['protected', 'prompt'])
       
   #gobject property methods
   def do_get_property(self, prop):
@@ -476,14 +2936,40 @@ class GtkPyInterpreterWidget(Gtk.VBox):
       return self._prop_margins
     elif prop.name == 'error-color':
       return self.gtk_stderr.get_color()
+    elif prop.name == 'timing-footer':
+      return self._prop_timing_footer
+    elif prop.name == 'memory-profiling':
+      return self._prop_memory_profiling
+    elif prop.name == 'fd-capture':
+      return self._prop_fd_capture
+    elif prop.name == 'wall-time-budget':
+      return self._prop_wall_time_budget
+    elif prop.name == 'cpu-time-budget':
+      return self._prop_cpu_time_budget
+    elif prop.name == 'memory-budget':
+      return self._prop_memory_budget
+    elif prop.name == 'session-directory':
+      return self._prop_session_directory
+    elif prop.name == 'session-autosave':
+      return self._prop_session_autosave
+    elif prop.name == 'image-memory':
+      return self._writer.images.get_memory()
+    elif prop.name == 'image-cache-size':
+      return self._writer.images.max_bytes
+    elif prop.name == 'completion-timeout':
+      return int(self._completer.timeout * 1000)
+    elif prop.name == 'max-scrollback-lines':
+      return self._writer.max_lines
+    elif prop.name == 'max-scrollback-chars':
+      return self._writer.max_chars
     else:
       return super(GtkPythonInterpreter, self).get_property(prop)
     
   def do_set_property(self, prop, val):
     if prop.name == 'auto-scroll':
       self._prop_auto_scroll = val
-      self._gtk_stdout.set_auto_scroll(val)
-      self._gtk_stderr.set_auto_scroll(val)
+      self.gtk_stdout.set_auto_scroll(val)
+      self.gtk_stderr.set_auto_scroll(val)
     elif prop.name == 'font':
       self._prop_font = val
       fontdesc = Pango.FontDescription(self._prop_font)
@@ -494,11 +2980,37 @@ class GtkPyInterpreterWidget(Gtk.VBox):
       self.output.set_right_margin(self._prop_margins)
     elif prop.name == 'error-color':
       self.gtk_stderr.set_color(val)
+    elif prop.name == 'timing-footer':
+      self._prop_timing_footer = val
+    elif prop.name == 'memory-profiling':
+      self._prop_memory_profiling = val
+      self.interpreter.set_memory_profiling(val)
+    elif prop.name == 'fd-capture':
+      self.interpreter.set_fd_capture(val)
+      self._prop_fd_capture = val
+    elif prop.name in ['wall-time-budget', 'cpu-time-budget',
+                       'memory-budget']:
+      setattr(self, '_prop_' + prop.name.replace('-', '_'), val)
+      self.interpreter.set_budgets(self._prop_wall_time_budget,
+                                   self._prop_cpu_time_budget,
+                                   self._prop_memory_budget)
+    elif prop.name in ['session-directory', 'session-autosave']:
+      setattr(self, '_prop_' + prop.name.replace('-', '_'), val)
+      self._schedule_autosave()
+    elif prop.name == 'image-cache-size':
+      self._writer.images.set_max_bytes(val)
+    elif prop.name == 'completion-timeout':
+      self._completer.timeout = val / 1000.0
+    elif prop.name == 'max-scrollback-lines':
+      self._writer.set_scrollback_limits(val, self._writer.max_chars)
+    elif prop.name == 'max-scrollback-chars':
+      self._writer.set_scrollback_limits(self._writer.max_lines, val)
     else:
       super(GtkPythonInterpreter, self).set_property(prop, val)
       
   #public methods
   def write(self, txt):
+    self._writer.flush()
     textbuffer = self.output.get_buffer()    
     textiter = textbuffer.get_end_iter()
     textbuffer.insert(textiter, txt)
@@ -514,6 +3026,45 @@ class GtkPyInterpreterWidget(Gtk.VBox):
     
   def get_margins(self):
     return self.get_property('margins')
+    
+  def get_completion_timeout(self):
+    return self.get_property('completion-timeout')
+    
+  def get_timing_footer(self):
+    return self.get_property('timing-footer')
+    
+  def get_memory_profiling(self):
+    return self.get_property('memory-profiling')
+    
+  def get_fd_capture(self):
+    return self.get_property('fd-capture')
+    
+  def get_wall_time_budget(self):
+    return self.get_property('wall-time-budget')
+    
+  def get_cpu_time_budget(self):
+    return self.get_property('cpu-time-budget')
+    
+  def get_memory_budget(self):
+    return self.get_property('memory-budget')
+    
+  def get_session_directory(self):
+    return self.get_property('session-directory')
+    
+  def get_session_autosave(self):
+    return self.get_property('session-autosave')
+    
+  def get_image_memory(self):
+    return self.get_property('image-memory')
+    
+  def get_image_cache_size(self):
+    return self.get_property('image-cache-size')
+    
+  def get_max_scrollback_lines(self):
+    return self.get_property('max-scrollback-lines')
+    
+  def get_max_scrollback_chars(self):
+    return self.get_property('max-scrollback-chars')
       
   def set_auto_scroll(self, scroll):
     self.set_property('auto-scroll', scroll)
@@ -527,11 +3078,212 @@ class GtkPyInterpreterWidget(Gtk.VBox):
   def set_margins(self, pixels):
     self.set_property('margins', pixels)
     
+  def set_completion_timeout(self, ms):
+    self.set_property('completion-timeout', ms)
+    
+  def set_timing_footer(self, footer):
+    self.set_property('timing-footer', footer)
+    
+  def set_memory_profiling(self, enabled):
+    self.set_property('memory-profiling', enabled)
+    
+  def set_fd_capture(self, enabled):
+    self.set_property('fd-capture', enabled)
+    
+  def set_wall_time_budget(self, seconds):
+    self.set_property('wall-time-budget', seconds)
+    
+  def set_cpu_time_budget(self, seconds):
+    self.set_property('cpu-time-budget', seconds)
+    
+  def set_memory_budget(self, n_bytes):
+    self.set_property('memory-budget', n_bytes)
+    
+  def set_session_directory(self, path):
+    self.set_property('session-directory', path)
+    
+  def set_session_autosave(self, seconds):
+    self.set_property('session-autosave', seconds)
+    
+  def set_image_cache_size(self, size):
+    self.set_property('image-cache-size', size)
+    
+  def set_max_scrollback_lines(self, lines):
+    self.set_property('max-scrollback-lines', lines)
+    
+  def set_max_scrollback_chars(self, chars):
+    self.set_property('max-scrollback-chars', chars)
+    
   def get_output_buffer(self):
     return self.output.get_buffer()
     
   def get_history(self):
     return self._history
+    
+  def get_statistics(self):
+    return self._statistics
+    
+  def get_memory_timeline(self):
+    #MemoryTimeline of the commands run while memory-profiling was enabled
+    return self._memory_timeline
+    
+  def set_statistics(self, statistics):
+    #a CommandStatistics object collecting the timing of all commands, or
+    #None
+    self._statistics = statistics
+    
+  def get_image(self, image_id):
+    #full resolution image if still cached, the thumbnail otherwise
+    pixbuf = self._writer.images.get(image_id)
+    if pixbuf == None:
+      textbuffer = self.output.get_buffer()
+      tag = textbuffer.get_tag_table().lookup('image-%d' % image_id)
+      if tag != None:
+        textiter = textbuffer.get_start_iter()
+        if textiter.forward_to_tag_toggle(tag):
+          pixbuf = textiter.get_pixbuf()
+    return pixbuf
+    
+  def save_image(self, image_id, filename, filetype='png'):
+    #returns False if the image has been removed from the output
+    pixbuf = self.get_image(image_id)
+    if pixbuf == None:
+      return False
+    pixbuf.savev(filename, filetype, [], [])
+    return True
+    
+  def show_image(self, image_id):
+    pixbuf = self.get_image(image_id)
+    if pixbuf == None:
+      return
+    w = Gtk.Window()
+    w.set_title('Image %d' % image_id)
+    w.set_default_size(min(pixbuf.get_width(), 1024) + 20,
+                       min(pixbuf.get_height(), 768) + 20)
+    sw = Gtk.ScrolledWindow()
+    sw.add_with_viewport(Gtk.Image.new_from_pixbuf(pixbuf))
+    w.add(sw)
+    w.show_all()
+    
+  def is_busy(self):
+    return self.interpreter.is_busy()
+    
+  def interrupt(self):
+    return self.interpreter.interrupt()
+    
+  def add_pre_execute_hook(self, hook):
+    self.interpreter.add_pre_execute_hook(hook)
+    
+  def remove_pre_execute_hook(self, hook):
+    self.interpreter.remove_pre_execute_hook(hook)
+    
+  def add_post_execute_hook(self, hook):
+    self.interpreter.add_post_execute_hook(hook)
+    
+  def remove_post_execute_hook(self, hook):
+    self.interpreter.remove_post_execute_hook(hook)
+    
+  def show_find_bar(self, query=None):
+    #searches the output written so far, Escape closes the bar
+    self._find_bar.show()
+    if query != None and query != self._find_entry.get_text():
+      self._find_entry.set_text(query)
+    else:
+      self._find_start()
+    self._find_entry.grab_focus()
+    
+  def hide_find_bar(self):
+    self._find_generation += 1
+    self._find_unhighlight()
+    self._find_matches = []
+    self._find_current = None
+    self._find_bar.hide()
+    self.output.grab_focus()
+    
+  def register_formatter(self, cls, formatter):
+    #formatter(value) returns the text shown for results that are instances
+    #of cls instead of their repr
+    self.interpreter.register_formatter(cls, formatter)
+    
+  def unregister_formatter(self, cls):
+    self.interpreter.unregister_formatter(cls)
+    
+  def run_source_block(self, source, filename='<input>'):
+    #runs the source like pasted text: it is shown as input, recorded as a
+    #single history entry and executed statement by statement; returns False
+    #if a command is still running
+    if self.is_busy():
+      return False
+    self._writer.flush()
+    self._input.reset()
+    self._replace_input(source.strip('\n'))
+    self._submit_input()
+    return True
+    
+  def run_file(self, filename):
+    #executes a script in the interpreter's namespace, returns False if a
+    #command is still running
+    if self.is_busy():
+      return False
+    f = open(filename)
+    source = f.read()
+    f.close()
+    self._writer.flush()
+    self._input.reset()
+    self._replace_input('# %s' % filename)
+    self._record_input('# %s' % filename)
+    textbuffer = self.output.get_buffer()
+    textbuffer.apply_tag_by_name('protected',
+                                 textbuffer.get_iter_at_mark(self._input_mark),
+                                 textbuffer.get_end_iter())
+    textbuffer.insert(textbuffer.get_end_iter(), '\n')
+    #like running the script, the values of expressions are not shown
+    self._run_block(source, filename, 'exec')
+    return True
+    
+  def save_session(self, path=None):
+    #saves the picklable variables to the directory path, by default the
+    #session directory, with a %save_session command; only values that have
+    #changed since the last save are written; returns False if a command is
+    #still running
+    return self._run_session_magic('save_session', path)
+    
+  def load_session(self, path=None):
+    #adds the variables saved in the directory path to the namespace with a
+    #%load_session command; large buffers are memory mapped; returns False
+    #if a command is still running
+    return self._run_session_magic('load_session', path)
+    
+  def start_transcript(self, filename, max_bytes=10 * 1024 * 1024,
+                       backup_count=5, compress=False, queue_size=10000):
+    #records inputs and outputs with timestamps as JSON lines, written by a
+    #background thread, see transcript.TranscriptWriter
+    self.stop_transcript()
+    self._writer.transcript = TranscriptWriter(filename, max_bytes,
+                                               backup_count, compress,
+                                               queue_size)
+    self._writer.transcript.write('session', 'started')
+    return self._writer.transcript
+    
+  def stop_transcript(self):
+    transcript = self._writer.transcript
+    if transcript != None:
+      self._writer.transcript = None
+      transcript.write('session', 'stopped')
+      transcript.close()
+      
+  def get_transcript(self):
+    return self._writer.transcript
+    
+  def restart(self):
+    self.gtk_stderr.write('\nInterpreter restarted.\n')
+    self._input.reset()
+    busy = self.is_busy()
+    self.interpreter.restart()
+    if not busy:
+      #otherwise the prompt is written when the interpreter reports the end
+      #of the running command
+      self._write_prompt(self.line_start)
       
       
 if __name__ == '__main__':
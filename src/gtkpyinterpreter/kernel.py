@@ -0,0 +1,719 @@
+from code import InteractiveInterpreter
+from asyncloop import TOP_LEVEL_AWAIT, AsyncLoop, is_async
+from budget import Watchdog
+from capture import FdCapture
+from collections import OrderedDict
+from display import ResultDisplay
+from lazy import LazyImport, LazyResolver
+from magics import MagicCommands
+from memory import MemoryProfiler
+from session import SessionStore
+import ast
+import importlib
+import inspect
+import linecache
+import os
+import re
+import signal
+import struct
+import sys
+import threading
+import time
+import types
+try:
+  import __builtin__ as builtins
+except ImportError:
+  import builtins
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+
+#messages are pickled tuples prefixed by their length
+PROTOCOL = 2
+HEADER = struct.Struct('!I')
+
+
+def encode_message(msg):
+  data = pickle.dumps(msg, PROTOCOL)
+  return HEADER.pack(len(data)) + data
+
+
+def read_message(f):
+  header = f.read(HEADER.size)
+  if len(header) < HEADER.size:
+    return None
+  n = HEADER.unpack(header)[0]
+  data = f.read(n)
+  if len(data) < n:
+    return None
+  return pickle.loads(data)
+
+
+class MessageReader(object):
+
+  #collects data read from a non-blocking pipe and splits it into messages
+
+  def __init__(self):
+    super(MessageReader, self).__init__()
+    self._buffer = b''
+
+  def feed(self, data):
+    self._buffer += data
+    messages = []
+    pos = 0
+    while len(self._buffer) - pos >= HEADER.size:
+      n = HEADER.unpack_from(self._buffer, pos)[0]
+      if len(self._buffer) - pos - HEADER.size < n:
+        break
+      start = pos + HEADER.size
+      messages.append(pickle.loads(self._buffer[start:start + n]))
+      pos = start + n
+    self._buffer = self._buffer[pos:]
+    return messages
+
+
+def split_statements(source, filename='<unknown>'):
+  #splits a block of code into its top-level statements, returns a list of
+  #(first line number, source) pairs; statements sharing a line stay
+  #together
+  tree = ast.parse(source, filename)
+  lines = source.splitlines()
+  starts = []
+  for node in tree.body:
+    lineno = node.lineno
+    for decorator in getattr(node, 'decorator_list', []):
+      lineno = min(lineno, decorator.lineno)
+    if starts == [] or lineno > starts[-1]:
+      starts.append(lineno)
+  statements = []
+  for i, start in enumerate(starts):
+    end = starts[i + 1] - 1 if i + 1 < len(starts) else len(lines)
+    statements.append((start, '\n'.join(lines[start - 1:end]).rstrip()))
+  return statements
+
+
+def run_block(interpreter, source, filename, progress=None,
+              progress_interval=0.1, symbol='single'):
+  #splits source into its top-level statements and executes them one after
+  #the other in the namespace of an InteractiveInterpreter, stops at the
+  #first exception; progress(i, n) is called at most every progress_interval
+  #seconds; statements are compiled like interactive input in 'single' mode,
+  #showing the values of expressions, or like a script in 'exec' mode;
+  #returns whether all statements were executed
+  try:
+    statements = split_statements(source, filename)
+  except (OverflowError, SyntaxError, ValueError):
+    interpreter.showsyntaxerror(filename)
+    return False
+  if filename.startswith('<'):
+    #makes the source available to tracebacks and inspect
+    linecache.cache[filename] = (len(source), None,
+                                 [line + '\n' for line in source.splitlines()],
+                                 filename)
+  reported = 0
+  for i, (lineno, statement) in enumerate(statements):
+    if progress != None and time.time() - reported >= progress_interval:
+      reported = time.time()
+      progress(i, len(statements))
+    try:
+      #the padding keeps the line numbers of the block
+      code = interpreter.compile.compiler('\n' * (lineno - 1) + statement +
+                                          '\n', filename, symbol)
+    except (OverflowError, SyntaxError, ValueError):
+      interpreter.showsyntaxerror(filename)
+      return False
+    try:
+      interpreter.lazy.resolve(code)
+      if is_async(code):
+        interpreter.run_coroutine(eval(code, interpreter.locals)).result()
+      else:
+        exec(code, interpreter.locals)
+    except SystemExit:
+      raise
+    except:
+      interpreter.showtraceback()
+      return False
+  return True
+
+
+class AttributeLister(object):
+
+  #lists the attributes of the object an expression like 'a.b.c' refers to
+  #without calling any user code: names are looked up in the instance and
+  #class dictionaries, properties and other descriptors are not evaluated;
+  #the names of at most cache_size classes are cached
+
+  cache_size = 256
+
+  def __init__(self):
+    super(AttributeLister, self).__init__()
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+
+  #private methods
+  def _instance_dict(self, obj):
+    if type(obj) is getattr(types, 'InstanceType', None):
+      #old-style instances, their __dict__ is looked up without user code
+      d = obj.__dict__
+    else:
+      try:
+        d = object.__getattribute__(obj, '__dict__')
+      except (AttributeError, TypeError):
+        #e.g. __slots__ without __dict__; getattr() would run __getattr__
+        return None
+    if issubclass(type(d), dict):
+      return d
+    return None
+
+  def _mro(self, obj):
+    if issubclass(type(obj), (type, getattr(types, 'ClassType', type))):
+      return inspect.getmro(obj)
+    #unlike type(), __class__ and isinstance() may run user code, e.g. of a
+    #property named __class__
+    cls = type(obj)
+    if cls is getattr(types, 'InstanceType', None):
+      #old-style instances, their class is looked up without user code
+      cls = obj.__class__
+    return inspect.getmro(cls)
+
+  def _getattr(self, obj, name):
+    if issubclass(type(obj), types.ModuleType):
+      return vars(obj)[name]
+    if not issubclass(type(obj), type):
+      d = self._instance_dict(obj)
+      if d != None and name in d:
+        return d[name]
+    for cls in self._mro(obj):
+      if name in cls.__dict__:
+        value = cls.__dict__[name]
+        if issubclass(type(value), types.MemberDescriptorType):
+          #__slots__ member, only the slot descriptor runs, unlike with
+          #getattr() which calls the instance's __getattribute__
+          return value.__get__(obj, type(obj))
+        if hasattr(type(value), '__set__'):
+          #properties and other data descriptors are not evaluated
+          raise LookupError(name)
+        return value
+    raise LookupError(name)
+
+  def _class_names(self, cls):
+    stamp = len(cls.__dict__)
+    with self._lock:
+      entry = self._cache.pop(cls, None)
+      if entry != None and entry[0] == stamp:
+        self._cache[cls] = entry
+        return entry[1]
+    names = set()
+    for c in inspect.getmro(cls):
+      names.update(c.__dict__.keys())
+    names = sorted(names)
+    with self._lock:
+      self._cache[cls] = (stamp, names)
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(False)
+    return names
+
+  #public methods
+  def resolve(self, namespace, expr):
+    #raises LookupError if expr cannot be resolved statically
+    if re.match(r'^\w+(\.\w+)*$', expr) == None:
+      raise LookupError(expr)
+    parts = expr.split('.')
+    if parts[0] in namespace:
+      obj = namespace[parts[0]]
+      if issubclass(type(obj), LazyImport):
+        #importing the module runs no user code
+        obj = obj.resolve(namespace)
+        namespace[parts[0]] = obj
+    elif parts[0] in vars(builtins):
+      obj = vars(builtins)[parts[0]]
+    else:
+      raise LookupError(parts[0])
+    for part in parts[1:]:
+      obj = self._getattr(obj, part)
+    return obj
+
+  def list(self, namespace, expr, names=None):
+    #appends the attribute names to names while they are collected, so
+    #that a caller in another thread can use partial results
+    if names == None:
+      names = []
+    obj = self.resolve(namespace, expr)
+    if issubclass(type(obj), types.ModuleType):
+      names.extend(sorted(vars(obj).keys()))
+      return names
+    if not issubclass(type(obj), type):
+      d = self._instance_dict(obj)
+      if d != None:
+        names.extend(sorted(d.keys()))
+    names.extend(self._class_names(self._mro(obj)[0]))
+    return names
+
+
+def cpu_time():
+  #cpu time of the calling thread if available, of the process otherwise
+  if hasattr(time, 'thread_time'):
+    return time.thread_time()
+  t = os.times()
+  return t[0] + t[1]
+
+
+class CodeCache(object):
+
+  #code objects of the latest size sources, commands repeated from the
+  #history are not compiled again
+
+  size = 256
+
+  def __init__(self):
+    super(CodeCache, self).__init__()
+    self._cache = OrderedDict()
+
+  def compile(self, compiler, source, filename, symbol):
+    #compiler is the codeop.CommandCompiler of an interpreter, its flags
+    #reflect the __future__ statements executed so far; returns None for
+    #incomplete input
+    key = (source, filename, symbol, compiler.compiler.flags)
+    code = self._cache.pop(key, None)
+    if code == None:
+      code = compiler(source, filename, symbol)
+      if code == None:
+        return None
+    self._cache[key] = code
+    while len(self._cache) > self.size:
+      self._cache.popitem(False)
+    return code
+
+
+class KernelInterpreter(InteractiveInterpreter):
+
+  #remembers the name of the exception raised by the last command; commands
+  #awaiting something run on an asyncio event loop, their background tasks
+  #run while the kernel waits for requests
+
+  exception = None
+
+  def __init__(self, namespace):
+    InteractiveInterpreter.__init__(self, namespace)
+    self.compile.compiler.flags |= TOP_LEVEL_AWAIT
+    self.code_cache = CodeCache()
+    self.lazy = LazyResolver(namespace)
+    self.async_loop = None
+
+  def runcode(self, code):
+    try:
+      self.lazy.resolve(code)
+      if is_async(code):
+        self.run_coroutine(eval(code, self.locals)).result()
+        return
+    except SystemExit:
+      raise
+    except:
+      self.showtraceback()
+      return
+    InteractiveInterpreter.runcode(self, code)
+
+  def run_coroutine(self, coroutine):
+    if self.async_loop == None:
+      self.async_loop = AsyncLoop()
+    return self.async_loop.run(coroutine)
+
+  def has_tasks(self):
+    if self.async_loop == None and 'asyncio' in sys.modules:
+      #tasks may have been scheduled on asyncio.get_event_loop()
+      self.async_loop = AsyncLoop()
+    return self.async_loop != None and self.async_loop.has_work()
+
+  def runsource(self, source, filename='<input>', symbol='single'):
+    try:
+      code = self.code_cache.compile(self.compile, source, filename, symbol)
+    except (OverflowError, SyntaxError, ValueError):
+      self.showsyntaxerror(filename)
+      return False
+    if code == None:
+      return True
+    self.runcode(code)
+    return False
+
+  def showtraceback(self, *args):
+    self.exception = sys.exc_info()[0].__name__
+    InteractiveInterpreter.showtraceback(self, *args)
+
+
+class KernelStream(object):
+
+  #file-like object replacing sys.stdout/sys.stderr in the kernel process
+
+  #pending output is sent when it exceeds this size or is older than
+  #max_delay seconds
+  max_size = 8192
+  max_delay = 0.05
+
+  def __init__(self, name, kernel):
+    super(KernelStream, self).__init__()
+    self.name = name
+    self._kernel = kernel
+    self._chunks = []
+    self._size = 0
+    self._time = 0
+    self._lock = threading.Lock()
+
+  def write(self, data):
+    with self._lock:
+      if self._chunks == []:
+        self._time = time.time()
+      self._chunks.append(data)
+      self._size += len(data)
+      if (self._size < self.max_size and
+          time.time() - self._time < self.max_delay):
+        return
+    self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def write_more(self, result):
+    #the rest of a displayed result is kept in the kernel
+    self.flush()
+    self._kernel.add_result(result)
+
+  def flush(self):
+    with self._lock:
+      data = ''.join(self._chunks)
+      self._chunks = []
+      self._size = 0
+    if data != '':
+      self._kernel.send((self.name, data))
+
+  def isatty(self):
+    return False
+
+
+class Kernel(object):
+
+  #executes the sources sent by a GtkSubprocessInterpreter
+
+  #number of incomplete results that can be expanded
+  max_results = 20
+  #seconds background tasks run at a time between requests
+  task_slice = 0.05
+
+  def __init__(self, rfile, wfile):
+    super(Kernel, self).__init__()
+    self._rfile = rfile
+    self._wfile = wfile
+    self._write_lock = threading.Lock()
+    self._requests = queue.Queue()
+    self._running = False
+    self._names = set()
+    self._lister = AttributeLister()
+    self.locals = {}
+    self.stdout = KernelStream('stdout', self)
+    self.stderr = KernelStream('stderr', self)
+    self.interpreter = KernelInterpreter(self.locals)
+    self.interpreter.write = self.stderr.write
+    self.magics = MagicCommands()
+    self.magics.resolver = self.interpreter.lazy
+    self.memory_profiler = None
+    self.fd_capture = None
+    self.watchdog = Watchdog()
+    #budget.BudgetExceeded subclass raised by the next SIGINT
+    self._exceeded = None
+    self.display = ResultDisplay()
+    self._results = OrderedDict()
+    self._result_id = 0
+    #like the widget's clear() of the in-process interpreter
+    self.locals['clear'] = self.clear
+    self.magics.session_exclude = self._session_exclude
+
+  #private methods
+  def _cb_sigint(self, signum, frame):
+    #only interrupt user code, never the kernel itself
+    if self._running:
+      exception = self._exceeded or KeyboardInterrupt
+      self._exceeded = None
+      raise exception
+
+  def _cb_budget_exceeded(self, exception):
+    #called by the watchdog thread, the signal also interrupts system calls
+    self._exceeded = exception
+    os.kill(os.getpid(), signal.SIGINT)
+
+  def _read_requests(self):
+    #runs in a separate thread so that requests can be answered while
+    #a command is being executed
+    while True:
+      msg = read_message(self._rfile)
+      if msg == None or msg[0] == 'shutdown':
+        self._requests.put(None)
+        return
+      elif msg[0] == 'attributes':
+        #answered right away, even while a command is running
+        try:
+          names = self._lister.list(self.locals, msg[2])
+        except Exception:
+          names = []
+        self.send(('attributes', msg[1], names))
+      else:
+        self._requests.put(msg)
+
+  def _flush_streams(self):
+    #sends output that was buffered while a command keeps running, or that
+    #a process started by a command wrote after it had finished
+    while True:
+      time.sleep(KernelStream.max_delay)
+      self.stdout.flush()
+      self.stderr.flush()
+
+  def _next_request(self):
+    while True:
+      if self.interpreter.has_tasks():
+        self._run_tasks()
+        try:
+          return self._requests.get_nowait()
+        except queue.Empty:
+          continue
+      try:
+        return self._requests.get(True, 0.5)
+      except queue.Empty:
+        pass
+
+  def _run_tasks(self):
+    #the output of background tasks is sent like the output of a command
+    sys.stdout = self.stdout
+    sys.stderr = self.stderr
+    sys.displayhook = self._displayhook
+    try:
+      self.interpreter.async_loop.run_for(self.task_slice)
+    except Exception:
+      self.interpreter.showtraceback()
+    finally:
+      sys.stdout = sys.__stdout__
+      sys.stderr = sys.__stderr__
+      sys.displayhook = sys.__displayhook__
+    self.stdout.flush()
+    self.stderr.flush()
+    self._send_namespace()
+
+  def _preload(self, path, modules):
+    #warms up a kernel waiting in a KernelPool
+    sys.path[:] = path
+    for module in modules:
+      try:
+        importlib.import_module(module)
+      except Exception:
+        pass
+
+  def _init(self, path, items):
+    sys.path[:] = path
+    for name, data in items.items():
+      try:
+        self.locals[name] = pickle.loads(data)
+      except Exception:
+        pass
+    self.interpreter.lazy.reset()
+
+  def _run_magic(self, name, args):
+    try:
+      self.magics.run(name, args, self.locals)
+    except SystemExit:
+      raise
+    except:
+      self.interpreter.showtraceback()
+
+  def _run_block(self, source, filename, symbol='single'):
+    run_block(self.interpreter, source, filename, self._send_progress,
+              symbol=symbol)
+
+  def _send_progress(self, i, n):
+    self.send(('progress', i, n))
+
+  def _displayhook(self, value):
+    self.display.displayhook(value, self.stdout)
+
+  def _expand(self, request_id, result_id):
+    result = self._results.get(result_id)
+    if result == None:
+      self.send(('expanded', request_id, '', True))
+      return
+    text, complete = self.display.expand(result)
+    if complete:
+      del self._results[result_id]
+    self.send(('expanded', request_id, text, complete))
+
+  def _add_formatter(self, data):
+    try:
+      cls, formatter = pickle.loads(data)
+    except Exception:
+      return
+    if formatter == None:
+      self.display.unregister(cls)
+    else:
+      self.display.register(cls, formatter)
+
+  def _run(self, function, *args):
+    #returns the timing of the command
+    self.interpreter.exception = None
+    if self.memory_profiler != None:
+      self.memory_profiler.start()
+    start = time.time()
+    cpu_start = cpu_time()
+    sys.stdout = self.stdout
+    sys.stderr = self.stderr
+    sys.displayhook = self._displayhook
+    if self.fd_capture != None:
+      self.fd_capture.start()
+    limited = self.watchdog.is_limited()
+    if limited:
+      self.watchdog.start(threading.current_thread().ident,
+                          self._cb_budget_exceeded)
+    try:
+      self._running = True
+      function(*args)
+      self._running = False
+    except KeyboardInterrupt as e:
+      #interrupted outside of the user code
+      self._running = False
+      self.interpreter.exception = type(e).__name__
+    if limited and self.watchdog.stop() != None:
+      self.stderr.write('Command interrupted: %s\n' %
+                        self.watchdog.describe())
+    self._exceeded = None
+    if self.fd_capture != None:
+      self.fd_capture.stop()
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    sys.displayhook = sys.__displayhook__
+    stats = {'wall': time.time() - start, 'cpu': cpu_time() - cpu_start,
+             'exception': self.interpreter.exception, 'memory': None}
+    if self.memory_profiler != None:
+      stats['memory'] = self.memory_profiler.stop()
+    self.stdout.flush()
+    self.stderr.flush()
+    self._send_namespace()
+    return stats
+
+  def _set_memory_profiling(self, enabled):
+    if enabled and self.memory_profiler == None:
+      self.memory_profiler = MemoryProfiler()
+      self.memory_profiler.enable()
+    elif not enabled and self.memory_profiler != None:
+      self.memory_profiler.disable()
+      self.memory_profiler = None
+
+  def _set_fd_capture(self, enabled):
+    #native output would otherwise go to the parent's stderr
+    if enabled and self.fd_capture == None:
+      self.fd_capture = FdCapture({1: self.stdout.write,
+                                   2: self.stderr.write})
+      self.fd_capture.enable()
+    elif not enabled and self.fd_capture != None:
+      self.fd_capture.disable()
+      self.fd_capture = None
+
+  def _save_session(self, request_id, path):
+    #e.g. an autosave, handled between commands like any other request
+    try:
+      summary = SessionStore(path).save(self.locals,
+                                        self._session_exclude())
+      error = None
+    except Exception as e:
+      summary = None
+      error = '%s: %s' % (type(e).__name__, e)
+    self.send(('saved', request_id, summary, error))
+
+  def _session_exclude(self):
+    if self.locals.get('clear') == self.clear:
+      return ['clear']
+    return []
+
+  def _send_namespace(self):
+    names = set(self.locals.keys())
+    added = list(names - self._names)
+    removed = list(self._names - names)
+    self._names = names
+    if added != [] or removed != []:
+      self.send(('namespace', added, removed))
+
+  #public methods
+  def add_result(self, result):
+    #an incomplete result, the interpreter can request the rest with its id
+    self._result_id += 1
+    self._results[self._result_id] = result
+    while len(self._results) > self.max_results:
+      self._results.popitem(False)
+    self.send(('more', self._result_id))
+
+  def clear(self):
+    #clears the widget's output, after the output written so far
+    self.stdout.flush()
+    self.stderr.flush()
+    self.send(('clear',))
+
+  def send(self, msg):
+    data = encode_message(msg)
+    with self._write_lock:
+      self._wfile.write(data)
+      self._wfile.flush()
+
+  def serve(self):
+    signal.signal(signal.SIGINT, self._cb_sigint)
+    for target in [self._read_requests, self._flush_streams]:
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+    self.send(('ready', os.getpid()))
+    while True:
+      msg = self._next_request()
+      if msg == None:
+        break
+      elif msg[0] == 'preload':
+        self._preload(*msg[1:])
+      elif msg[0] == 'init':
+        self._init(*msg[1:])
+        self._send_namespace()
+      elif msg[0] == 'run':
+        self.send(('done', self._run(self.interpreter.runsource, *msg[1:])))
+      elif msg[0] == 'magic':
+        self.send(('done', self._run(self._run_magic, *msg[1:])))
+      elif msg[0] == 'block':
+        self.send(('done', self._run(self._run_block, *msg[1:])))
+      elif msg[0] == 'memory-profiling':
+        self._set_memory_profiling(msg[1])
+      elif msg[0] == 'budgets':
+        self.watchdog = Watchdog(*msg[1:])
+      elif msg[0] == 'fd-capture':
+        self._set_fd_capture(msg[1])
+      elif msg[0] == 'expand':
+        self._expand(*msg[1:])
+      elif msg[0] == 'formatter':
+        self._add_formatter(msg[1])
+      elif msg[0] == 'save-session':
+        self._save_session(*msg[1:])
+    #output of processes started by commands and buffered output
+    self._set_fd_capture(False)
+    self.stdout.flush()
+    self.stderr.flush()
+
+
+def main():
+  #the pipes to the parent process are moved away from stdin and stdout,
+  #writes to the standard file descriptors go to the parent's stderr
+  rfile = os.fdopen(os.dup(0), 'rb')
+  wfile = os.fdopen(os.dup(1), 'wb')
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+  os.dup2(2, 1)
+  Kernel(rfile, wfile).serve()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,130 @@
+import dis
+import importlib
+import types
+try:
+  import __builtin__ as builtins
+except ImportError:
+  import builtins
+
+
+#the namespace stays a plain dict: a dict subclass resolving its entries in
+#__missing__ would slow down every lookup of a builtin name considerably,
+#instead the interpreter resolves the entries a command is about to load
+
+
+def loaded_names(code):
+  #global names loaded by a code object and the code objects defined in it
+  names = set()
+  if hasattr(dis, 'get_instructions'):
+    for instruction in dis.get_instructions(code):
+      if instruction.opname in ['LOAD_NAME', 'LOAD_GLOBAL',
+                                'LOAD_FROM_DICT_OR_GLOBALS']:
+        names.add(instruction.argval)
+  else:
+    names.update(code.co_names)
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      names.update(loaded_names(const))
+  return names
+
+
+class Lazy(object):
+
+  #placeholder for a namespace entry that is created by factory(*args) when
+  #the first command using its name is run
+
+  def __init__(self, factory, *args):
+    super(Lazy, self).__init__()
+    self.factory = factory
+    self.args = args
+
+  def resolve(self, namespace):
+    return self.factory(*self.args)
+
+  def __repr__(self):
+    return '<lazy %r>' % (self.factory,)
+
+
+class LazyImport(Lazy):
+
+  #a module, or an attribute of it, imported on first use; unlike other Lazy
+  #entries it can be passed to the kernel process and is resolved for the
+  #attribute completion
+
+  def __init__(self, module, attribute=None):
+    Lazy.__init__(self, None)
+    self.module = module
+    self.attribute = attribute
+
+  def resolve(self, namespace):
+    module = importlib.import_module(self.module)
+    if self.attribute == None:
+      return module
+    return getattr(module, self.attribute)
+
+  def __repr__(self):
+    if self.attribute == None:
+      return '<lazy import %s>' % self.module
+    return '<lazy import %s.%s>' % (self.module, self.attribute)
+
+
+class LazyStarImport(LazyImport):
+
+  #imports the module like 'from module import *' as soon as a command uses
+  #a name that is not defined yet; existing names are not replaced and the
+  #entry itself becomes the module
+
+  def resolve(self, namespace):
+    module = LazyImport.resolve(self, namespace)
+    names = getattr(module, '__all__', None)
+    if names == None:
+      names = [name for name in vars(module).keys()
+               if not name.startswith('_')]
+    for name in names:
+      if not name in namespace:
+        namespace[name] = getattr(module, name)
+    return module
+
+
+class LazyResolver(object):
+
+  #resolves the Lazy entries of a namespace before a code object using them
+  #is executed; costs nothing once all entries are resolved
+
+  def __init__(self, namespace):
+    super(LazyResolver, self).__init__()
+    self.namespace = namespace
+    self.reset()
+
+  def _resolve(self, name):
+    value = self.namespace.get(name)
+    if isinstance(value, Lazy):
+      self.namespace[name] = value.resolve(self.namespace)
+    self._names.discard(name)
+
+  #public methods
+  def reset(self):
+    #scans the namespace for Lazy entries, e.g. after a restart
+    self._names = set([name for name, value in self.namespace.items()
+                       if isinstance(value, Lazy)])
+
+  def add(self, name, value):
+    self.namespace[name] = value
+    if isinstance(value, Lazy):
+      self._names.add(name)
+
+  def is_pending(self):
+    return self._names != set()
+
+  def resolve(self, code):
+    if self._names == set():
+      return
+    names = loaded_names(code)
+    for name in names & self._names:
+      self._resolve(name)
+    undefined = [name for name in names if not name in self.namespace and
+                 not name in vars(builtins)]
+    if undefined != []:
+      for name in list(self._names):
+        if isinstance(self.namespace.get(name), LazyStarImport):
+          self._resolve(name)
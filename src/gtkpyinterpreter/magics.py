@@ -0,0 +1,263 @@
+import cProfile
+import inspect
+import linecache
+import math
+import pstats
+import sys
+import timeit
+from memory import format_size, memit
+from session import SessionStore, format_summary
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import StringIO
+
+
+def format_time(seconds):
+  for unit, factor in [('s', 1.0), ('ms', 1e3), ('us', 1e6)]:
+    if seconds >= 1.0 / factor:
+      return '%.3g %s' % (seconds * factor, unit)
+  return '%.3g ns' % (seconds * 1e9)
+
+
+def parse_options(args, options):
+  #splits leading options like '-n 100' from the statement; options maps
+  #the option letters to their default values
+  options = dict(options)
+  args = args.strip()
+  while args.startswith('-') and len(args) > 1 and args[1] in options:
+    parts = args[2:].strip().split(None, 1)
+    if parts == []:
+      raise ValueError('option -%s requires a value' % args[1])
+    options[args[1]] = type(options[args[1]])(parts[0])
+    args = parts[1] if len(parts) > 1 else ''
+  return options, args
+
+
+class LineTimer(object):
+
+  #collects the time spent on each line of a single code object using
+  #sys.settrace
+
+  def __init__(self, code):
+    super(LineTimer, self).__init__()
+    self.code = code
+    self.timings = {}
+    self._line = None
+    self._time = 0
+
+  def _record(self):
+    now = timeit.default_timer()
+    if self._line != None:
+      hits, total = self.timings.get(self._line, (0, 0.0))
+      self.timings[self._line] = (hits + 1, total + now - self._time)
+    return now
+
+  def _trace_global(self, frame, event, arg):
+    if event == 'call' and frame.f_code is self.code:
+      self._line = None
+      return self._trace_local
+    return None
+
+  def _trace_local(self, frame, event, arg):
+    if event == 'line':
+      self._time = self._record()
+      self._line = frame.f_lineno
+    elif event == 'return':
+      self._record()
+      self._line = None
+    return self._trace_local
+
+  def run(self, code, namespace):
+    previous = sys.gettrace()
+    sys.settrace(self._trace_global)
+    try:
+      exec(code, namespace)
+    finally:
+      sys.settrace(previous)
+
+  def format(self):
+    filename = self.code.co_filename
+    first = self.code.co_firstlineno
+    try:
+      lines = inspect.getsourcelines(self.code)[0]
+    except (IOError, TypeError):
+      lines = [linecache.getline(filename, n) for n in
+               range(first, max(list(self.timings.keys()) + [first]) + 1)]
+    total = sum([t for hits, t in self.timings.values()])
+    out = ['Total time: %s' % format_time(total),
+           'File: %s' % filename,
+           'Function: %s at line %d' % (self.code.co_name, first), '',
+           '%6s %10s %12s %12s %8s  %s' % ('Line', 'Hits', 'Time',
+                                           'Per Hit', '% Time',
+                                           'Line Contents'),
+           '=' * 72]
+    for i, line in enumerate(lines):
+      lineno = first + i
+      line = line.rstrip('\n')
+      if lineno in self.timings:
+        hits, t = self.timings[lineno]
+        out.append('%6d %10d %12s %12s %8.1f  %s' %
+                   (lineno, hits, format_time(t), format_time(t / hits),
+                    t / total * 100 if total > 0 else 0, line))
+      else:
+        out.append('%6d %10s %12s %12s %8s  %s' % (lineno, '', '', '', '',
+                                                   line))
+    return '\n'.join(out) + '\n'
+
+
+class MagicCommands(object):
+
+  #commands starting with '%' that are not passed to the Python interpreter;
+  #the results are written to sys.stdout, i.e. to the buffered output of the
+  #widget or of the kernel process
+
+  #minimum total time of the loops when %timeit determines the number of
+  #loops itself
+  timeit_min_time = 0.2
+  prun_limit = 30
+
+  def __init__(self):
+    super(MagicCommands, self).__init__()
+    #lazy.LazyResolver of the namespace, if any
+    self.resolver = None
+    #function returning the names %save_session leaves out, if any
+    self.session_exclude = None
+    self._magics = {'timeit': self.timeit,
+                    'prun': self.prun,
+                    'lprun': self.lprun,
+                    'memit': self.memit,
+                    'save_session': self.save_session,
+                    'load_session': self.load_session}
+
+  def _compile(self, source, filename, symbol='exec'):
+    code = compile(source, filename, symbol)
+    if self.resolver != None:
+      self.resolver.resolve(code)
+    return code
+
+  #public methods
+  def parse(self, line):
+    #returns (name, arguments) if line is a magic command, None otherwise
+    line = line.strip()
+    if not line.startswith('%') or line.startswith('%%'):
+      return None
+    parts = line[1:].split(None, 1)
+    if parts == []:
+      return None
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+  def has_magic(self, name):
+    return name in self._magics
+
+  def get_names(self):
+    return sorted(self._magics.keys())
+
+  def run(self, name, args, namespace):
+    self._magics[name](args, namespace)
+
+  #magics
+  def timeit(self, args, namespace):
+    #%timeit [-n loops] [-r repeat] statement
+    options, stmt = parse_options(args, {'n': 0, 'r': 7})
+    if stmt == '':
+      raise ValueError('usage: %timeit [-n loops] [-r repeat] statement')
+    source = ('def __timeit(__loops, __timer):\n' +
+              '  __start = __timer()\n' +
+              '  for __i in range(__loops):\n' +
+              '    %s\n' % stmt +
+              '  return __timer() - __start\n')
+    functions = {}
+    #the function's globals are the interpreter's namespace
+    exec(self._compile(source, '<timeit>'), namespace, functions)
+    inner = functions['__timeit']
+    loops = options['n']
+    if loops <= 0:
+      #1, 2, 5, 10, 20, 50, ... until the loops take timeit_min_time
+      loops = 1
+      while True:
+        t = inner(loops, timeit.default_timer)
+        if t >= self.timeit_min_time:
+          break
+        for factor in [2, 5, 10]:
+          if t * factor >= self.timeit_min_time or factor == 10:
+            loops *= factor
+            break
+    times = [inner(loops, timeit.default_timer) / loops
+             for i in range(max(options['r'], 1))]
+    mean = sum(times) / len(times)
+    std = math.sqrt(sum([(t - mean) ** 2 for t in times]) / len(times))
+    sys.stdout.write('%s +- %s per loop (mean +- std. dev. of %d runs, ' %
+                     (format_time(mean), format_time(std), len(times)) +
+                     '%d loops each, best %s)\n' % (loops,
+                                                    format_time(min(times))))
+
+  def prun(self, args, namespace):
+    #%prun [-s sort key] [-l number of lines] statement
+    options, stmt = parse_options(args, {'s': 'cumulative',
+                                         'l': self.prun_limit})
+    if stmt == '':
+      raise ValueError('usage: %prun [-s sort] [-l lines] statement')
+    code = self._compile(stmt, '<prun>')
+    profile = cProfile.Profile()
+    try:
+      profile.runctx(code, namespace, namespace)
+    finally:
+      #the table is written as a single block
+      result = StringIO()
+      stats = pstats.Stats(profile, stream=result)
+      stats.strip_dirs().sort_stats(options['s']).print_stats(options['l'])
+      sys.stdout.write(result.getvalue())
+
+  def lprun(self, args, namespace):
+    #%lprun -f function statement
+    options, stmt = parse_options(args, {'f': ''})
+    if options['f'] == '' or stmt == '':
+      raise ValueError('usage: %lprun -f function statement')
+    function = eval(self._compile(options['f'], '<lprun>', 'eval'), namespace)
+    function = getattr(function, '__func__', function)
+    code = getattr(function, '__code__', None)
+    if code == None:
+      raise TypeError('%s is not a Python function' % options['f'])
+    timer = LineTimer(code)
+    try:
+      timer.run(self._compile(stmt, '<lprun>'), namespace)
+    finally:
+      sys.stdout.write(timer.format())
+
+  def memit(self, args, namespace):
+    #%memit statement
+    if args.strip() == '':
+      raise ValueError('usage: %memit statement')
+    peak, increment = memit(self._compile(args.strip(), '<memit>'),
+                            namespace)
+    if peak == None:
+      #see memory.memit
+      peak_text = 'unavailable while tracing'
+    else:
+      peak_text = format_size(peak)
+    sys.stdout.write('peak memory: %s, increment: %s\n' %
+                     (peak_text, format_size(increment)))
+
+  def save_session(self, args, namespace):
+    #%save_session directory
+    if args.strip() == '':
+      raise ValueError('usage: %save_session directory')
+    exclude = ()
+    if self.session_exclude != None:
+      exclude = self.session_exclude()
+    summary = SessionStore(args.strip()).save(namespace, exclude)
+    sys.stdout.write(format_summary(summary, args.strip()) + '\n')
+
+  def load_session(self, args, namespace):
+    #%load_session directory
+    if args.strip() == '':
+      raise ValueError('usage: %load_session directory')
+    store = SessionStore(args.strip())
+    if not store.exists():
+      raise IOError('no session saved in %s' % args.strip())
+    summary = store.load(namespace)
+    if self.resolver != None:
+      #loaded values may replace lazy placeholders
+      self.resolver.reset()
+    sys.stdout.write(format_summary(summary, args.strip()) + '\n')
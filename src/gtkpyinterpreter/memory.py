@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from collections import deque
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+
+def rss():
+  #resident set size in bytes, Linux only, 0 elsewhere
+  try:
+    f = open('/proc/self/statm')
+    pages = int(f.read().split()[1])
+    f.close()
+    return pages * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError):
+    return 0
+
+
+def format_size(n):
+  sign = '-' if n < 0 else '+'
+  n = abs(n)
+  for unit in ['B', 'kB', 'MB']:
+    if n < 1024:
+      return '%s%.4g %s' % (sign, n, unit)
+    n /= 1024.0
+  return '%s%.4g GB' % (sign, n)
+
+
+class MemoryProfiler(object):
+
+  #measures the memory allocated by a command: the traced Python
+  #allocations and the top allocation sites if tracemalloc is available,
+  #the change of the resident set size otherwise
+
+  #number of allocation sites reported
+  top = 5
+
+  def __init__(self):
+    super(MemoryProfiler, self).__init__()
+    self._snapshot = None
+    self._traced = 0
+    self._rss = 0
+    self._started_tracing = False
+
+  def enable(self):
+    if tracemalloc != None and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self._started_tracing = True
+
+  def disable(self):
+    if self._started_tracing:
+      tracemalloc.stop()
+      self._started_tracing = False
+    self._snapshot = None
+
+  def start(self):
+    self._rss = rss()
+    if tracemalloc != None and tracemalloc.is_tracing():
+      self._snapshot = tracemalloc.take_snapshot()
+      self._traced = tracemalloc.get_traced_memory()[0]
+
+  def stop(self):
+    #returns a dictionary with the net changes
+    current_rss = rss()
+    result = {'rss': current_rss, 'rss_delta': current_rss - self._rss,
+              'traced': None, 'delta': None, 'top': []}
+    if self._snapshot != None and tracemalloc.is_tracing():
+      result['traced'] = tracemalloc.get_traced_memory()[0]
+      result['delta'] = result['traced'] - self._traced
+      snapshot = tracemalloc.take_snapshot()
+      #allocations of the console itself are not reported
+      snapshot = snapshot.filter_traces([
+                     tracemalloc.Filter(False, tracemalloc.__file__),
+                     tracemalloc.Filter(False, os.path.join(
+                         os.path.dirname(os.path.abspath(__file__)), '*'))])
+      stats = snapshot.compare_to(self._snapshot, 'lineno')
+      for stat in stats[:self.top]:
+        if stat.size_diff != 0:
+          frame = stat.traceback[0]
+          result['top'].append(('%s:%d' % (frame.filename, frame.lineno),
+                                stat.size_diff, stat.count_diff))
+    else:
+      result['delta'] = result['rss_delta']
+    self._snapshot = None
+    return result
+
+
+class MemoryTimeline(object):
+
+  #memory usage after each of the latest size commands, see
+  #GtkPyInterpreterWidget.get_memory_timeline
+
+  def __init__(self, size=10000):
+    super(MemoryTimeline, self).__init__()
+    self._records = deque(maxlen=size)
+    self._lock = threading.Lock()
+
+  def add(self, source, memory):
+    with self._lock:
+      self._records.append({'time': time.time(), 'source': source,
+                            'rss': memory['rss'], 'traced': memory['traced'],
+                            'delta': memory['delta']})
+
+  def clear(self):
+    with self._lock:
+      self._records.clear()
+
+  def get_records(self):
+    with self._lock:
+      return list(self._records)
+
+
+def memit(statement, namespace):
+  #runs statement once, returns the peak and the net increment of the
+  #traced memory relative to the start, without tracemalloc both are the
+  #increment of the resident set size; the peak is None if it cannot be
+  #measured, i.e. before Python 3.9 while tracing is on already, e.g. for
+  #the memory profiler, since the peak cannot be reset then
+  if tracemalloc == None:
+    before = rss()
+    exec(statement, namespace)
+    increment = rss() - before
+    return increment, increment
+  started = not tracemalloc.is_tracing()
+  if started:
+    tracemalloc.start()
+  try:
+    resettable = hasattr(tracemalloc, 'reset_peak')
+    if resettable:
+      tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    exec(statement, namespace)
+    current, peak = tracemalloc.get_traced_memory()
+    if not resettable and not started:
+      #the highest usage since tracing was started
+      return None, current - before
+    return peak - before, current - before
+  finally:
+    if started:
+      tracemalloc.stop()
@@ -0,0 +1,212 @@
+import hashlib
+import mmap
+import os
+import re
+import time
+import types
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+
+#protocol 5 pickles large buffers out-of-band, Python 3.8 and later
+PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+#alignment of the buffers in a buffer file
+ALIGNMENT = 64
+
+replace_file = getattr(os, 'replace', os.rename)
+#names of the files written by a SessionStore besides its index, other
+#files in the directory are never removed
+OBJECT_FILE = re.compile(r'^[0-9a-f]{40}\.(pickle|buffers)(\.tmp)?$')
+
+
+class SessionStore(object):
+
+  #a directory holding the picklable variables of a namespace; each value
+  #is pickled on its own into a file named by the digest of its content, so
+  #a repeated save only writes the values that have changed; buffers of at
+  #least min_buffer_size bytes, e.g. of numpy arrays, are written out-of-band
+  #to a buffer file that is memory mapped when the session is loaded
+
+  index_name = 'index.pickle'
+  min_buffer_size = 65536
+
+  def __init__(self, path):
+    super(SessionStore, self).__init__()
+    self.path = path
+
+  #private methods
+  def _file(self, name):
+    return os.path.join(self.path, name)
+
+  def _read_index(self):
+    try:
+      f = open(self._file(self.index_name), 'rb')
+    except IOError:
+      return {'variables': {}, 'objects': {}}
+    try:
+      return pickle.load(f)
+    finally:
+      f.close()
+
+  def _write(self, name, chunks):
+    #written completely before it replaces an existing file
+    temp = self._file(name + '.tmp')
+    f = open(temp, 'wb')
+    try:
+      for chunk in chunks:
+        f.write(chunk)
+    finally:
+      f.close()
+    replace_file(temp, self._file(name))
+
+  def _dumps(self, value):
+    #returns the pickle and its out-of-band buffers
+    buffers = []
+    if PROTOCOL < 5:
+      return pickle.dumps(value, PROTOCOL), buffers
+    def out_of_band(buffer):
+      try:
+        view = buffer.raw()
+      except BufferError:
+        #not contiguous, pickled in-band
+        return True
+      if view.nbytes < self.min_buffer_size:
+        return True
+      buffers.append(view)
+      return False
+    return pickle.dumps(value, PROTOCOL, buffer_callback=out_of_band), buffers
+
+  def _digest(self, data, buffers):
+    h = hashlib.sha1(data)
+    for view in buffers:
+      h.update(view)
+    return h.hexdigest()
+
+  def _write_object(self, digest, data, buffers):
+    #returns the (offset, size) of each buffer in the buffer file
+    layout = []
+    if buffers != []:
+      chunks = []
+      offset = 0
+      for view in buffers:
+        padding = -offset % ALIGNMENT
+        chunks.append(b'\0' * padding)
+        offset += padding
+        layout.append((offset, view.nbytes))
+        chunks.append(view)
+        offset += view.nbytes
+      self._write(digest + '.buffers', chunks)
+    self._write(digest + '.pickle', [data])
+    return layout
+
+  def _read_object(self, digest, layout):
+    f = open(self._file(digest + '.pickle'), 'rb')
+    try:
+      data = f.read()
+    finally:
+      f.close()
+    if layout == []:
+      return pickle.loads(data)
+    f = open(self._file(digest + '.buffers'), 'rb')
+    try:
+      #private mapping: arrays are writable, changes stay in memory
+      view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    finally:
+      f.close()
+    return pickle.loads(data, buffers=[view[offset:offset + size]
+                                       for offset, size in layout])
+
+  def _remove_unused(self, objects):
+    for name in os.listdir(self.path):
+      if (OBJECT_FILE.match(name) != None and
+          not name.split('.')[0] in objects):
+        try:
+          os.remove(self._file(name))
+        except OSError:
+          pass
+
+  #public methods
+  def exists(self):
+    return os.path.exists(self._file(self.index_name))
+
+  def save(self, namespace, exclude=()):
+    #pickles the variables except for modules, names starting with '_' and
+    #those in exclude; values that cannot be pickled are skipped; returns a
+    #summary with the lists of 'written', 'unchanged' and 'skipped' names and
+    #the number of bytes written
+    start = time.time()
+    if not os.path.isdir(self.path):
+      os.makedirs(self.path)
+    old = self._read_index()
+    index = {'variables': {}, 'objects': {}}
+    summary = {'written': [], 'unchanged': [], 'skipped': [], 'bytes': 0}
+    for name in sorted(namespace.keys()):
+      value = namespace[name]
+      if (name.startswith('_') or name in exclude or
+          isinstance(value, types.ModuleType)):
+        continue
+      try:
+        data, buffers = self._dumps(value)
+      except Exception:
+        summary['skipped'].append(name)
+        continue
+      digest = self._digest(data, buffers)
+      if digest in index['objects']:
+        #shared with another variable
+        pass
+      elif (digest in old['objects'] and
+            os.path.exists(self._file(digest + '.pickle'))):
+        index['objects'][digest] = old['objects'][digest]
+      else:
+        index['objects'][digest] = self._write_object(digest, data, buffers)
+        summary['bytes'] += len(data) + sum([view.nbytes
+                                             for view in buffers])
+      index['variables'][name] = digest
+      if old['variables'].get(name) == digest:
+        summary['unchanged'].append(name)
+      else:
+        summary['written'].append(name)
+    self._write(self.index_name, [pickle.dumps(index, 2)])
+    self._remove_unused(index['objects'])
+    summary['time'] = time.time() - start
+    return summary
+
+  def load(self, namespace):
+    #adds the saved variables to namespace; returns a summary with the lists
+    #of 'loaded' and 'failed' names
+    start = time.time()
+    index = self._read_index()
+    summary = {'loaded': [], 'failed': []}
+    for name, digest in sorted(index['variables'].items()):
+      try:
+        namespace[name] = self._read_object(digest,
+                                            index['objects'][digest])
+        summary['loaded'].append(name)
+      except Exception:
+        summary['failed'].append(name)
+    summary['time'] = time.time() - start
+    return summary
+
+
+def format_names(names, limit=5):
+  if len(names) > limit:
+    return ', '.join(names[:limit]) + ', ...'
+  return ', '.join(names)
+
+
+def format_summary(summary, path):
+  #a line describing the summary of SessionStore.save or load
+  if 'loaded' in summary:
+    text = 'loaded %d variables from %s in %.2f s' % (len(summary['loaded']),
+                                                      path, summary['time'])
+    if summary['failed'] != []:
+      text += ', failed: %s' % format_names(summary['failed'])
+    return text
+  text = ('saved %d variables to %s in %.2f s, %d written (%d bytes)' %
+          (len(summary['written']) + len(summary['unchanged']), path,
+           summary['time'], len(summary['written']), summary['bytes']))
+  if summary['skipped'] != []:
+    text += ', not picklable: %s' % format_names(summary['skipped'])
+  return text
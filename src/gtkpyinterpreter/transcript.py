@@ -0,0 +1,185 @@
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+
+class TranscriptWriter(object):
+
+  #writes the records of a console session as JSON lines from a background
+  #thread; write() never blocks: records that do not fit into the bounded
+  #queue are dropped and counted, the number of dropped records is written
+  #as a 'dropped' record as soon as the queue has room again
+
+  #number of records written at once
+  batch_size = 256
+  #seconds between checks whether the writer has been closed while the
+  #queue is empty
+  poll_interval = 0.5
+
+  def __init__(self, filename, max_bytes=10 * 1024 * 1024, backup_count=5,
+               compress=False, queue_size=10000):
+    super(TranscriptWriter, self).__init__()
+    self.filename = filename
+    #the file is rotated when it would exceed max_bytes, 0 for no limit; at
+    #most backup_count old files are kept, gzip compressed if compress
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+    self.compress = compress
+    self.dropped = 0
+    self.written = 0
+    self._unreported = 0
+    self._lock = threading.Lock()
+    self._queue = queue.Queue(queue_size)
+    self._closed = False
+    self._open()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  #private methods
+  def _put(self, record):
+    try:
+      self._queue.put_nowait(record)
+      return True
+    except queue.Full:
+      return False
+
+  def _encode(self, record):
+    timestamp, kind, text = record
+    return (json.dumps({'time': timestamp, 'kind': kind, 'text': text},
+                       sort_keys=True) + '\n').encode('utf-8')
+
+  def _backup_name(self, n):
+    name = '%s.%d' % (self.filename, n)
+    if self.compress:
+      name += '.gz'
+    return name
+
+  def _open(self):
+    self._file = open(self.filename, 'ab')
+    self._size = self._file.tell()
+
+  def _compress(self):
+    src = open(self.filename, 'rb')
+    try:
+      dst = gzip.open(self._backup_name(1), 'wb')
+      try:
+        shutil.copyfileobj(src, dst)
+      finally:
+        dst.close()
+    finally:
+      src.close()
+    os.remove(self.filename)
+
+  def _rotate(self):
+    self._file.close()
+    try:
+      if self.backup_count > 0:
+        for n in range(self.backup_count - 1, 0, -1):
+          if os.path.exists(self._backup_name(n)):
+            os.rename(self._backup_name(n), self._backup_name(n + 1))
+        if self.compress:
+          self._compress()
+        else:
+          os.rename(self.filename, self._backup_name(1))
+      else:
+        os.remove(self.filename)
+    finally:
+      #if the rotation failed the current file is simply continued
+      self._open()
+
+  def _write_batch(self, records):
+    if self._file.closed:
+      #reopening failed after an earlier rotation
+      self._open()
+    for record in records:
+      data = self._encode(record)
+      if (self.max_bytes > 0 and self._size > 0 and
+          self._size + len(data) > self.max_bytes):
+        self._file.flush()
+        self._rotate()
+      self._file.write(data)
+      self._size += len(data)
+    self._file.flush()
+    self.written += len(records)
+
+  def _finish(self):
+    with self._lock:
+      unreported = self._unreported
+      self._unreported = 0
+    try:
+      if unreported > 0:
+        self._write_batch([(time.time(), 'dropped', str(unreported))])
+    except Exception:
+      pass
+    self._file.close()
+
+  def _run(self):
+    while True:
+      try:
+        record = self._queue.get(True, self.poll_interval)
+      except queue.Empty:
+        if not self._closed:
+          continue
+        record = None
+      records = []
+      while record != None:
+        records.append(record)
+        if len(records) >= self.batch_size:
+          break
+        try:
+          record = self._queue.get_nowait()
+        except queue.Empty:
+          break
+      try:
+        self._write_batch(records)
+      except Exception:
+        #the transcript must not take the console down, the thread goes on
+        #with the next batch
+        with self._lock:
+          self.dropped += len(records)
+      if record == None:
+        self._finish()
+        return
+
+  #public methods
+  def write(self, kind, text):
+    #kind is e.g. 'input', 'stdout' or 'stderr'; safe to call from any
+    #thread
+    timestamp = time.time()
+    with self._lock:
+      if self._closed:
+        return
+      if self._unreported > 0:
+        if not self._put((timestamp, 'dropped', str(self._unreported))):
+          self._unreported += 1
+          self.dropped += 1
+          return
+        self._unreported = 0
+      if not self._put((timestamp, kind, text)):
+        self._unreported += 1
+        self.dropped += 1
+
+  def get_pending(self):
+    return self._queue.qsize()
+
+  def close(self, timeout=0):
+    #does not wait for the pending records by default, so a slow disk does
+    #not block the caller: the thread writes them and closes the file once
+    #the queue is empty; returns whether it has finished within timeout
+    #seconds
+    with self._lock:
+      if self._closed:
+        return not self._thread.is_alive()
+      self._closed = True
+    #wakes the thread up right away if the queue has room
+    self._put(None)
+    self._thread.join(timeout)
+    return not self._thread.is_alive()